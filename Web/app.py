@@ -1,11 +1,64 @@
-from flask import Flask, render_template
+import hashlib
+import json
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
 
-from generator import GameState
+import chess
+from flask import Flask, Response, jsonify, render_template, request
+
+from cache import EvalCache
+from engine_pool import EnginePool
+from generator import GameState, SearchContext, puzzle_record
+from jobs import JobManager, QueueFull, SingleFlight, search_key
+from metrics import REGISTRY
+from puzzle_index import PuzzleIndex
+from tablebase import Tablebase
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = "lkajdghdadkglajkgah1"
+# SQLite file to keep engine verdicts across restarts (None keeps them in memory only)
+app.config['ENGINE_CACHE_PATH'] = None
+app.config['ENGINE_CACHE_SIZE'] = 200000
+# Directory of Syzygy tablebase files, endgames covered by them skip the engine (None: engine only)
+app.config['SYZYGY_PATH'] = None
+# Precomputed puzzles (see puzzle_index.py), new results are appended to its delta segment (None: always search)
+app.config['PUZZLE_INDEX_PATH'] = None
+# Stockfish processes shared by all requests (None: one per CPU)
+app.config['ENGINE_POOL_SIZE'] = None
+# Background puzzle searches: worker threads and how many jobs may wait for one
+app.config['JOB_WORKERS'] = 2
+app.config['JOB_QUEUE_SIZE'] = 16
+# Synchronous searches (/get-fens): how many run at once and how many may wait for one, beyond that 503
+app.config['SEARCH_SLOTS'] = 2
+app.config['SEARCH_WAITING'] = 8
+# JSON API: positions per request and how long clients and CDNs may reuse a response
+app.config['API_MAX_FENS'] = 16
+app.config['API_MAX_AGE'] = 3600
+
+# One search object for every request, each search gets its own SearchContext
+engine_cache = EvalCache(max_size=app.config['ENGINE_CACHE_SIZE'], path=app.config['ENGINE_CACHE_PATH'])
+tablebase = Tablebase(app.config['SYZYGY_PATH']) if app.config['SYZYGY_PATH'] else None
+engine_pool = EnginePool(size=app.config['ENGINE_POOL_SIZE'], cache=engine_cache, tablebase=tablebase)
+engine_pool.warm_up()
+game_state = GameState(engines=engine_pool)
+puzzle_index = PuzzleIndex(app.config['PUZZLE_INDEX_PATH']) if app.config['PUZZLE_INDEX_PATH'] else None
+job_manager = JobManager(game_state, workers=app.config['JOB_WORKERS'], max_queue=app.config['JOB_QUEUE_SIZE'],
+                         puzzle_index=puzzle_index)
+# Equal concurrent searches run once and share the result
+searches = SingleFlight(max_active=app.config['SEARCH_SLOTS'], max_waiting=app.config['SEARCH_WAITING'])
 
-game_state = GameState()
+REGISTRY.gauge("engine_cache_hits", lambda: engine_cache.hits, "Engine verdicts served from the cache")
+REGISTRY.gauge("engine_cache_misses", lambda: engine_cache.misses, "Engine verdicts not found in the cache")
+REGISTRY.gauge("engine_cache_size", lambda: len(engine_cache), "Engine verdicts in memory")
+REGISTRY.gauge("engines_started", lambda: engine_pool.started, "Running Stockfish processes")
+if tablebase is not None:
+    REGISTRY.gauge("tablebase_hits", lambda: tablebase.hits, "Engine verdicts served from the tablebase")
+if puzzle_index is not None:
+    REGISTRY.gauge("puzzle_index_hits", lambda: puzzle_index.hits, "Positions answered from the puzzle index")
+    REGISTRY.gauge("puzzle_index_misses", lambda: puzzle_index.misses, "Positions not found in the puzzle index")
+    REGISTRY.gauge("puzzle_index_merge_failures", lambda: puzzle_index.merge_failures,
+                   "Background merges of the puzzle index delta that failed")
+REGISTRY.gauge("jobs_queued", lambda: job_manager.pending, "Jobs waiting for a worker")
+REGISTRY.gauge("searches_in_flight", lambda: searches.in_flight, "Synchronous searches running or waiting")
 
 
 @app.route("/")
@@ -26,14 +79,165 @@ def gen_html(puzzles):
     return html_link
 
 
+def find_puzzles(context):
+    """ Puzzle records of a search, from the puzzle index when it has them """
+    records = puzzle_index.get(context.fen, context.max_depth) if puzzle_index is not None else None
+    if records is None:
+        results = game_state.get_puzzles(context=context)
+        records = [puzzle_record(move_type, depth, row) for move_type, rows in results.items() for depth, row in rows]
+        if puzzle_index is not None:
+            puzzle_index.add(context.fen, context.max_depth, records)
+    return records
+
+
 @app.route("/get-fens-<fen_pos>", methods=["GET", "POST"])
 def get_fens(fen_pos):
     fen_pos = fen_pos.replace("^", "/")
-    print(fen_pos)
-    game_state.update_initial(fen_pos)
-    puzzles = game_state.get_puzzles()
-    print(puzzles)
-    return gen_html(puzzles)
+    context = SearchContext(fen_pos)
+    try:
+        records = searches.do(search_key(context), lambda: find_puzzles(context))
+    except QueueFull as error:
+        response = jsonify(error=str(error))
+        response.headers["Retry-After"] = "10"
+        return response, 503
+    return gen_html([record["fen"] for record in records])
+
+
+@app.route("/api/puzzles", methods=["GET", "POST"])
+def api_puzzles():
+    """
+        Puzzles of one or many positions as JSON.
+
+        GET takes repeated fen query parameters, POST a JSON body with "fen" or "fens", both take max_depth.
+        Responses carry an ETag of their content and may be cached for API_MAX_AGE seconds, a matching
+        If-None-Match is answered with 304 (repeated searches mostly come from the puzzle index).
+    """
+    try:
+        if request.method == "POST":
+            data = request.get_json(silent=True)
+            if not isinstance(data, dict):
+                raise ValueError("the body must be a JSON object")
+            fens = data["fens"] if "fens" in data else [data["fen"]] if "fen" in data else []
+            max_depth = data.get("max_depth", 6)
+        else:
+            fens = request.args.getlist("fen")
+            max_depth = request.args.get("max_depth", 6)
+
+        if not isinstance(fens, list):
+            raise ValueError("fens must be a list of FEN strings")
+        if not fens:
+            raise ValueError("at least one fen is required")
+        if len(fens) > app.config['API_MAX_FENS']:
+            raise ValueError(f"at most {app.config['API_MAX_FENS']} fens per request")
+        for fen in fens:
+            if not isinstance(fen, str):
+                raise ValueError("every fen must be a string")
+            chess.Board(fen)
+        max_depth = int(max_depth)
+        if not 1 < max_depth <= 10:
+            raise ValueError("max_depth must be between 2 and 10")
+    except (TypeError, ValueError) as error:
+        return jsonify(error=str(error)), 400
+
+    contexts = [SearchContext(fen, max_depth) for fen in fens]
+    keys = [search_key(context) for context in contexts]
+
+    # Positions of a request are searched side by side, at most as many as may run at once
+    executor = ThreadPoolExecutor(max_workers=min(len(contexts), app.config['SEARCH_SLOTS']))
+    flights = [executor.submit(searches.do, key, lambda context=context: find_puzzles(context))
+               for key, context in zip(keys, contexts)]
+    try:
+        # The first rejection answers at once, searches already running finish in the background
+        done, _ = wait(flights, return_when=FIRST_EXCEPTION)
+        for flight in done:
+            if flight.exception() is not None:
+                raise flight.exception()
+        results = [flight.result() for flight in flights]
+    except QueueFull as error:
+        response = jsonify(error=str(error))
+        response.headers["Retry-After"] = "10"
+        return response, 503
+    finally:
+        for flight in flights:
+            flight.cancel()
+        executor.shutdown(wait=False)
+
+    body = {"results": [{"fen": context.fen, "max_depth": context.max_depth, "puzzles": records}
+                        for context, records in zip(contexts, results)]}
+    tag = hashlib.sha1(json.dumps(body, sort_keys=True).encode()).hexdigest()
+    headers = {"ETag": f'"{tag}"', "Cache-Control": f"public, max-age={app.config['API_MAX_AGE']}"}
+    if tag in request.if_none_match:
+        return Response(status=304, headers=headers)
+    response = jsonify(body)
+    response.headers.update(headers)
+    return response
+
+
+@app.route("/jobs", methods=["POST"])
+def submit_job():
+    data = request.get_json(silent=True) if request.is_json else request.form
+    try:
+        if not isinstance(data, dict):
+            raise ValueError("the body must be a JSON object")
+        fen = data.get("fen", "")
+        if not isinstance(fen, str):
+            raise ValueError("fen must be a string")
+        chess.Board(fen)
+        max_depth = int(data.get("max_depth", 6))
+        if not 1 < max_depth <= 10:
+            raise ValueError("max_depth must be between 2 and 10")
+    except (TypeError, ValueError) as error:
+        return jsonify(error=str(error)), 400
+    trace = str(data.get("trace", "")).lower() in ("1", "true", "yes")
+
+    try:
+        job = job_manager.submit(fen, max_depth=max_depth, trace=trace)
+    except QueueFull as error:
+        response = jsonify(error=str(error))
+        response.headers["Retry-After"] = "10"
+        return response, 503
+
+    return jsonify(id=job.id, status=job.status), 202
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify(error="unknown job"), 404
+    return jsonify(job.to_dict())
+
+
+@app.route("/jobs/<job_id>", methods=["DELETE"])
+def cancel_job(job_id):
+    job = job_manager.cancel(job_id)
+    if not job:
+        return jsonify(error="unknown job"), 404
+    return jsonify(id=job.id, status=job.status)
+
+
+@app.route("/jobs/<job_id>/events", methods=["GET"])
+def job_events(job_id):
+    """ Server-sent events with the job state on every change, until the job is finished """
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify(error="unknown job"), 404
+
+    def stream():
+        version = None
+        while True:
+            version = job.wait(version, timeout=15)
+            yield f"data: {json.dumps(job.to_dict())}\n\n"
+            if job.is_finished:
+                return
+
+    return Response(stream(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """ Prometheus text exposition of the search metrics """
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
 
 
 if __name__ == '__main__':
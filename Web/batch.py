@@ -0,0 +1,230 @@
+"""
+    Mines puzzles from a corpus of positions.
+
+        python batch.py positions.fen --output puzzles.jsonl --workers 8
+        python batch.py games.pgn --output puzzles --format parquet --time-budget 10
+
+    Inputs are read as a stream: one FEN per line, or the final position of every game of a PGN file.
+    Every worker process owns its own GameState and engines. Output is written in input order and a
+    checkpoint is stored every --checkpoint-every positions, running the same command again resumes.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import chess.pgn
+
+import engine_pool
+from generator import GameState, SearchContext, puzzle_record
+from tablebase import Tablebase
+
+# GameState of the worker process
+_game_state = None
+_options = None
+
+
+def read_fens(path: str):
+    """ Yields the FENs of a file with one position per line (blank lines and # comments are skipped) """
+    with open(path) as file:
+        for line in file:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield line
+
+
+def read_pgn_end_positions(path: str):
+    """ Yields the final position of every game of a PGN file """
+    with open(path) as file:
+        while True:
+            game = chess.pgn.read_game(file)
+            if game is None:
+                return
+            yield game.end().board().fen()
+
+
+def init_worker(options: dict) -> None:
+    global _game_state, _options
+    _options = options
+    if options["stockfish"]:
+        engine_pool.stockfish_path = options["stockfish"]
+    tablebase = Tablebase(options["syzygy"]) if options["syzygy"] else None
+    _game_state = GameState(pool_size=options["engines"], tablebase=tablebase)
+
+
+def solve(index: int, fen: str) -> dict:
+    record = {"index": index, "fen": fen, "puzzles": [], "error": None}
+    try:
+        context = SearchContext(fen, _options["max_depth"], time_budget=_options["time_budget"])
+        results = _game_state.get_puzzles(context=context)
+    except Exception as error:
+        record["error"] = f"{type(error).__name__}: {error}"
+        return record
+
+    for move_type, rows in results.items():
+        record["puzzles"].extend(puzzle_record(move_type, depth, row) for depth, row in rows)
+    return record
+
+
+class JsonlWriter:
+    """ One line per input position, resuming truncates everything written after the checkpoint """
+
+    def __init__(self, path: str, state: dict = None) -> None:
+        self.path = path
+        self.file = open(path, "a+b")
+        if state is not None:
+            self.file.truncate(state["offset"])
+        else:
+            self.file.truncate(0)
+        self.file.seek(0, os.SEEK_END)
+
+    def write(self, record: dict) -> None:
+        self.file.write(json.dumps(record).encode() + b"\n")
+
+    def flush(self) -> dict:
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return {"offset": self.file.tell()}
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class ParquetWriter:
+    """ One row per puzzle, every checkpoint writes a new part file into the output directory """
+
+    def __init__(self, path: str, state: dict = None) -> None:
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise SystemExit("Parquet output needs pyarrow (pip install pyarrow)")
+        self.pyarrow = pyarrow
+
+        self.path = path
+        self.parts = state["parts"] if state is not None else 0
+        os.makedirs(path, exist_ok=True)
+        for part in glob.glob(os.path.join(path, "part-*.parquet")):
+            if int(os.path.basename(part)[5:10]) >= self.parts:
+                os.remove(part)
+        self.rows = []
+
+    def write(self, record: dict) -> None:
+        for puzzle in record["puzzles"]:
+            row = {"index": record["index"], "source_fen": record["fen"]}
+            row.update(puzzle)
+            row["heuristics"] = json.dumps(puzzle["heuristics"])
+            self.rows.append(row)
+
+    def flush(self) -> dict:
+        if self.rows:
+            table = self.pyarrow.Table.from_pylist(self.rows)
+            self.pyarrow.parquet.write_table(table, os.path.join(self.path, f"part-{self.parts:05d}.parquet"))
+            self.parts += 1
+            self.rows = []
+        return {"parts": self.parts}
+
+    def close(self) -> None:
+        self.flush()
+
+
+WRITERS = {
+    "jsonl": JsonlWriter,
+    "parquet": ParquetWriter,
+}
+
+
+def load_checkpoint(path: str, args) -> dict:
+    if not os.path.exists(path):
+        return None
+    with open(path) as file:
+        checkpoint = json.load(file)
+    if checkpoint["input"] != os.path.abspath(args.input) or checkpoint["format"] != args.format:
+        raise SystemExit(f"{path} belongs to another run, remove it to start over")
+    return checkpoint
+
+
+def save_checkpoint(path: str, args, next_index: int, writer_state: dict) -> None:
+    checkpoint = {
+        "input": os.path.abspath(args.input),
+        "format": args.format,
+        "next_index": next_index,
+        "writer": writer_state,
+    }
+    with open(path + ".tmp", "w") as file:
+        json.dump(checkpoint, file)
+    os.replace(path + ".tmp", path)
+
+
+def run(args) -> None:
+    checkpoint_path = args.checkpoint or args.output.rstrip("/") + ".checkpoint"
+    checkpoint = load_checkpoint(checkpoint_path, args)
+    start = checkpoint["next_index"] if checkpoint else 0
+    writer = WRITERS[args.format](args.output, checkpoint["writer"] if checkpoint else None)
+
+    pgn = args.input.lower().endswith(".pgn") if args.input_format == "auto" else args.input_format == "pgn"
+    positions = read_pgn_end_positions(args.input) if pgn else read_fens(args.input)
+
+    options = {"stockfish": args.stockfish, "engines": args.engines, "syzygy": args.syzygy,
+               "max_depth": args.max_depth, "time_budget": args.time_budget}
+    # Futures in input order, at most `window` positions are in flight at any time
+    window = args.workers * 2
+    pending = deque()
+    done, puzzles = start, 0
+    _start = last_report = time.time()
+
+    def write_oldest():
+        nonlocal done, puzzles
+        record = pending.popleft().result()
+        writer.write(record)
+        done += 1
+        puzzles += len(record["puzzles"])
+        if (done - start) % args.checkpoint_every == 0:
+            save_checkpoint(checkpoint_path, args, done, writer.flush())
+
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(options,)) as pool:
+        for index, fen in enumerate(positions):
+            if index < start:
+                continue
+            pending.append(pool.submit(solve, index, fen))
+            if len(pending) >= window:
+                write_oldest()
+
+            if time.time() - last_report >= args.report_every:
+                last_report = time.time()
+                rate = (done - start) / (last_report - _start)
+                print(f"{done} positions, {puzzles} puzzles, {rate:.2f} positions/s", file=sys.stderr)
+
+        while pending:
+            write_oldest()
+
+    save_checkpoint(checkpoint_path, args, done, writer.flush())
+    writer.close()
+    elapsed = time.time() - _start
+    print(f"Finished: {done} positions ({done - start} new), {puzzles} new puzzles in {elapsed:.1f}s", file=sys.stderr)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="FEN file (one per line) or PGN file")
+    parser.add_argument("--output", required=True, help="JSONL file, or directory for parquet parts")
+    parser.add_argument("--format", choices=list(WRITERS), default="jsonl")
+    parser.add_argument("--input-format", choices=["auto", "fen", "pgn"], default="auto")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--engines", type=int, default=1, help="Stockfish processes per worker")
+    parser.add_argument("--stockfish", help="path of the Stockfish binary")
+    parser.add_argument("--syzygy", help="directory of Syzygy tablebases, probed instead of the engine")
+    parser.add_argument("--max-depth", type=int, default=6)
+    parser.add_argument("--time-budget", type=float, default=None, help="seconds per position")
+    parser.add_argument("--checkpoint", help="checkpoint file (default: <output>.checkpoint)")
+    parser.add_argument("--checkpoint-every", type=int, default=100)
+    parser.add_argument("--report-every", type=float, default=10, help="seconds between progress lines")
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+"""
+    Benchmarks for the puzzle generator, results are printed as JSON.
+
+        python benchmark.py startup --repeat 5
+        python benchmark.py movegen heuristics --output results.json
+        python benchmark.py search --max-depth 4 --baseline results.json
+
+    With --baseline every timing that got more than --tolerance worse is listed under
+    "regressions" and the exit status is 1.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+WEB_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Fixed positions, from sparse endgames to crowded middlegames
+CORPUS = {
+    "queen_mate": "8/8/8/8/8/5K2/6Q1/7k b - - 0 1",
+    "rook_endgame": "8/8/4k3/8/2R5/8/3K4/6r1 w - - 0 50",
+    "pawn_endgame": "8/5pk1/6p1/8/5P2/6PK/8/8 w - - 0 40",
+    "minor_pieces": "8/3b2k1/5p2/3N4/8/1B3K2/8/8 b - - 0 45",
+    "fools_mate": "rnb1kbnr/pppp1ppp/8/4p3/6Pq/5P2/PPPPP2P/RNBQKBNR w KQkq - 1 3",
+    "scholars_mate": "r1bqkb1r/pppp1Qpp/2n2n2/4p3/2B1P3/8/PPPP1PPP/RNB1K1NR b KQkq - 0 4",
+    "generator_main": "2rQ3r/1p1b1B2/p2k4/3Rn3/PP2p1pp/8/4K1P1/2R5 b - - 1 35",
+    "open_middlegame": "r1b2rk1/pp1nqppp/2p1p3/3n4/2BP4/2N2N2/PPQ2PPP/R3R1K1 w - - 0 13",
+    "closed_middlegame": "r2q1rk1/pp2bppp/2n1pn2/3p4/2PP4/2N1PN2/PP2BPPP/R2Q1RK1 w - - 0 10",
+}
+
+# Runs in a fresh interpreter so that every measurement is a cold start
+STARTUP_SNIPPET = """
+import json, sys, time
+_start = time.perf_counter()
+
+import engine_pool
+if sys.argv[1]:
+    engine_pool.stockfish_path = sys.argv[1]
+from generator import GameState
+imported = time.perf_counter()
+
+game_state = GameState()
+constructed = time.perf_counter()
+
+game_state.engines.top_move("rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq - 0 1")
+first_verdict = time.perf_counter()
+
+# What the constructor used to pay up front: every engine of the pool started
+game_state.engines.warm_up(wait=True)
+warmed_up = time.perf_counter()
+
+print(json.dumps({
+    "import_s": imported - _start,
+    "game_state_init_s": constructed - imported,
+    "first_verdict_s": first_verdict - constructed,
+    "full_warm_up_s": warmed_up - first_verdict,
+    "engines": game_state.engines.size,
+}))
+"""
+
+
+def summary(values: list) -> dict:
+    return {
+        "median": statistics.median(values),
+        "min": min(values),
+        "max": max(values),
+    }
+
+
+def percentiles(values: list) -> dict:
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {"p50": p50, "p90": p90, "p99": p99, "max": max(values)}
+
+
+def timed(function, repeat: int) -> float:
+    """ Best wall-clock seconds of a call out of repeat """
+    best = float("inf")
+    for _ in range(repeat):
+        _start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - _start)
+    return best
+
+
+def bench_startup(args) -> dict:
+    runs = []
+    for _ in range(args.repeat):
+        output = subprocess.run([sys.executable, "-c", STARTUP_SNIPPET, args.stockfish or ""], cwd=WEB_DIR,
+                                capture_output=True, text=True, check=True)
+        runs.append(json.loads(output.stdout.strip().splitlines()[-1]))
+
+    result = {name: summary([run[name] for run in runs]) for name in runs[0] if name.endswith("_s")}
+    result["engines"] = runs[0]["engines"]
+    return result
+
+
+def bench_movegen(args) -> dict:
+    """ get_all_moves on every corpus position """
+    from move_generator import MoveGenerator
+
+    move_generator = MoveGenerator()
+    result = {}
+    for name, fen in CORPUS.items():
+        seconds = timed(lambda: move_generator.get_all_moves(fen), args.repeat)
+        moves = sum(len(moves) for moves in move_generator.get_all_moves(fen).values())
+        result[name] = {"retro_moves": moves, "call_us": seconds * 1e6, "moves_per_s": moves / seconds}
+
+    total = sum(position["call_us"] for position in result.values()) / 1e6
+    result["positions_per_s"] = len(CORPUS) / total
+    return result
+
+
+def heuristic_sample() -> list:
+    """ The corpus positions and their retro-predecessors, as the search scores them (see GameState._expand) """
+    from move_generator import MoveGenerator, RetroBoard
+
+    move_generator = MoveGenerator()
+    fens = list(CORPUS.values())
+    for fen in CORPUS.values():
+        board = RetroBoard(fen)
+        fens.extend(board.fen() for _ in move_generator.children(board))
+    return fens
+
+
+def bench_heuristics(args) -> dict:
+    """ Every heuristic function on its own and the batch scorer, per position """
+    from generator import SearchContext
+    from heuristics import Heuristics
+
+    heuristics = Heuristics()
+    fens = heuristic_sample()
+    result = {"positions": len(fens)}
+    for name, function in heuristics.heuristic_functions.items():
+        seconds = timed(lambda: [function(fen, None, None) for fen in fens], args.repeat)
+        result[f"{name.lower()}_us"] = seconds / len(fens) * 1e6
+
+    seconds = timed(lambda: [heuristics.get_all_heuristics(fen) for fen in fens], args.repeat)
+    result["get_all_heuristics_us"] = seconds / len(fens) * 1e6
+    seconds = timed(lambda: heuristics.get_all_heuristics_batch(fens), args.repeat)
+    result["get_all_heuristics_batch_us"] = seconds / len(fens) * 1e6
+
+    # Early exit at the threshold of the search: positions skipped by the upper bounds, none of them may
+    # have a total above the threshold
+    threshold = SearchContext._field_defaults["min_heuristic"]
+    seconds = timed(lambda: heuristics.score_batch(fens, threshold=threshold), args.repeat)
+    result["score_batch_threshold_us"] = seconds / len(fens) * 1e6
+    totals = heuristics.score_batch(fens)
+    skipped = np.isnan(heuristics.score_batch(fens, threshold=threshold))
+    result["threshold_skipped"] = float(skipped.mean())
+    result["threshold_skipped_wrongly"] = int((totals[skipped] > threshold).sum())
+    return result
+
+
+def bench_search(args) -> dict:
+    """ End-to-end get_puzzles on every corpus position, with a cold engine cache each time """
+    from generator import GameState, SearchContext
+
+    game_state = GameState(pool_size=args.engines)
+    game_state.engines.warm_up(wait=True)
+    cache = game_state.engines.cache
+
+    latencies = []
+    positions = {}
+    for _ in range(args.repeat):
+        for name, fen in CORPUS.items():
+            cache.clear()
+            _start = time.perf_counter()
+            results = game_state.get_puzzles(context=SearchContext(fen, args.max_depth))
+            latencies.append(time.perf_counter() - _start)
+
+            puzzles = sum(len(rows) for rows in results.values())
+            # Every cache miss is one engine call
+            positions[name] = {"puzzles": puzzles, "engine_calls": cache.misses}
+
+    engine_calls = sum(position["engine_calls"] for position in positions.values())
+    puzzles = sum(position["puzzles"] for position in positions.values())
+    game_state.engines.close()
+    return {
+        "latency_s": percentiles(latencies),
+        "engine_calls_per_puzzle": engine_calls / puzzles if puzzles else None,
+        "max_depth": args.max_depth,
+        "engines": game_state.engines.size,
+        "positions": positions,
+    }
+
+
+BENCHMARKS = {
+    "startup": bench_startup,
+    "movegen": bench_movegen,
+    "heuristics": bench_heuristics,
+    "search": bench_search,
+}
+
+
+def regressions(results: dict, baseline: dict, tolerance: float, timing: bool = False, path: str = "") -> list:
+    """
+        Metrics that are more than tolerance worse than in the baseline. Timings (*_s, *_us and
+        the summaries under them) and engine calls per puzzle should go down, throughputs (*_per_s) up
+    """
+    found = []
+    for name, value in results.items():
+        key = f"{path}.{name}" if path else name
+        previous = baseline.get(name)
+        if isinstance(value, dict):
+            if isinstance(previous, dict):
+                found.extend(regressions(value, previous, tolerance, name.endswith(("_s", "_us")), key))
+            continue
+        if not isinstance(value, (int, float)) or not isinstance(previous, (int, float)) or not previous or not value:
+            continue
+
+        if name.endswith("_per_s"):
+            change = previous / value - 1
+        elif timing or name.endswith(("_s", "_us", "_per_puzzle")):
+            change = value / previous - 1
+        else:
+            continue
+        if change > tolerance:
+            found.append({"metric": key, "baseline": previous, "value": value, "change": change})
+    return found
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmarks", nargs="*", help=f"any of {', '.join(BENCHMARKS)} (default: all)")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--stockfish", help="path of the Stockfish binary")
+    parser.add_argument("--engines", type=int, default=None, help="engine pool size of the search benchmark")
+    parser.add_argument("--max-depth", type=int, default=4, help="max_depth of the search benchmark")
+    parser.add_argument("--output", help="also write the results to this file")
+    parser.add_argument("--baseline", help="results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed slowdown against the baseline")
+    args = parser.parse_args()
+
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+
+    if args.stockfish:
+        import engine_pool
+        engine_pool.stockfish_path = args.stockfish
+
+    results = {name: BENCHMARKS[name](args) for name in args.benchmarks or BENCHMARKS}
+    if args.baseline:
+        with open(args.baseline) as file:
+            results["regressions"] = regressions(results, json.load(file), args.tolerance)
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output)
+    if results.get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
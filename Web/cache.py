@@ -0,0 +1,111 @@
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+def normalize_fen(fen_position: str) -> str:
+    """ Drops the move clocks, positions that only differ by them get the same engine verdict """
+    return " ".join(fen_position.split()[:4])
+
+
+class EvalCache:
+    """
+        Bounded LRU cache of engine verdicts keyed by (normalized FEN, search depth).
+
+        Entries are the engine's top move records {"Move", "Centipawn", "Mate"} (None when the
+        position has no legal move). When a SQLite path is given, verdicts are also written
+        through to disk and looked up there on a memory miss, so they survive restarts.
+    """
+
+    def __init__(self, max_size: int = 100000, path: str = None) -> None:
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS verdicts ("
+                "fen TEXT, depth INTEGER, move TEXT, centipawn INTEGER, mate INTEGER, "
+                "PRIMARY KEY (fen, depth))"
+            )
+            self._db.commit()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key) -> bool:
+        fen_position, depth = key
+        return (normalize_fen(fen_position), depth) in self._entries
+
+    @property
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._entries),
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def get(self, fen_position: str, depth: int):
+        """ Returns (found, verdict) """
+        key = (normalize_fen(fen_position), depth)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, self._entries[key]
+
+            found, verdict = self._load(key)
+            if found:
+                self._store(key, verdict)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return found, verdict
+
+    def put(self, fen_position: str, depth: int, verdict) -> None:
+        self.put_many([(fen_position, verdict)], depth)
+
+    def put_many(self, verdicts: list, depth: int) -> None:
+        """ Stores a list of (fen, verdict) pairs, written to disk in a single transaction """
+        with self._lock:
+            rows = []
+            for fen_position, verdict in verdicts:
+                key = (normalize_fen(fen_position), depth)
+                self._store(key, verdict)
+                if verdict:
+                    rows.append((key[0], depth, verdict["Move"], verdict["Centipawn"], verdict["Mate"]))
+                else:
+                    rows.append((key[0], depth, None, None, None))
+
+            if self._db is not None and rows:
+                self._db.executemany("INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?, ?)", rows)
+                self._db.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def _store(self, key, verdict) -> None:
+        self._entries[key] = verdict
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _load(self, key):
+        if self._db is None:
+            return False, None
+        row = self._db.execute("SELECT move, centipawn, mate FROM verdicts WHERE fen = ? AND depth = ?",
+                               key).fetchone()
+        if row is None:
+            return False, None
+        move, centipawn, mate = row
+        return True, ({"Move": move, "Centipawn": centipawn, "Mate": mate} if move else None)
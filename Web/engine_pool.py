@@ -0,0 +1,380 @@
+import asyncio
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import EvalCache, normalize_fen
+from tablebase import Tablebase
+from uci import AsyncUciEngine, UciEngine
+
+stockfish_path = "stockfish_14.1_win_x64_avx2/stockfish_14.1_win_x64_avx2.exe"
+
+
+# Returned by _analyse for positions skipped because the budget ran out
+SKIPPED = object()
+
+
+class SearchBudget:
+    """
+        Wall-clock and engine-node limits of one search, shared by all of its engine calls.
+        Either limit may be None (unlimited).
+    """
+
+    def __init__(self, time_budget: float = None, node_budget: int = None) -> None:
+        self.started = time.time()
+        self.deadline = self.started + time_budget if time_budget is not None else None
+        self.node_budget = node_budget
+        self.nodes = 0
+        # Set by the search when the beam had to cut children, a wider beam could find more
+        self.trimmed = False
+        self._lock = threading.Lock()
+
+    @property
+    def remaining_time(self) -> float:
+        return self.deadline - time.time() if self.deadline is not None else float("inf")
+
+    @property
+    def exhausted(self) -> bool:
+        if self.deadline is not None and time.time() >= self.deadline:
+            return True
+        return self.node_budget is not None and self.nodes >= self.node_budget
+
+    def spend(self, nodes: int) -> None:
+        with self._lock:
+            self.nodes += nodes
+
+
+class EnginePool:
+    """
+        Pool of long-lived Stockfish processes.
+
+        Every worker thread leases an idle engine from a shared queue, so a
+        fast worker simply picks up the next position (work-stealing) while
+        slow searches are still running. Results are always returned in the
+        order the positions were submitted.
+
+        Verdicts are looked up in the Syzygy tablebase (when one is given) and
+        then in an EvalCache, positions repeated within a batch are only analysed once.
+
+        Engines are started lazily, the first lease of each slot spawns its
+        process. warm_up() starts the remaining ones in the background.
+
+        Engines keep their hash between searches, ucinewgame is only sent when an
+        engine gets a position of another game (see the game argument of top_moves).
+    """
+
+    def __init__(self, size: int = None, depth: int = 8, path: str = None, cache: EvalCache = None,
+                 tablebase: Tablebase = None) -> None:
+        self.size = size or os.cpu_count() or 1
+        self.depth = depth
+        self.path = path or stockfish_path
+        self.cache = cache if cache is not None else EvalCache()
+        self.tablebase = tablebase
+
+        # Idle engines, up to size processes are started on demand
+        self._engines = queue.Queue()
+        self._started = 0
+        self._start_lock = threading.Lock()
+        # Seconds spent starting engines, searches leave them out of their time estimates
+        self.startup_seconds = 0.0
+
+        self._executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="engine")
+
+    def top_move(self, fen_position: str, depth: int = None) -> dict:
+        """ Returns the best move of a position as {"Move", "Centipawn", "Mate"} (None if there is no move) """
+        return self.top_moves([fen_position], depth=depth)[0]
+
+    def top_moves(self, fen_positions: list, depth: int = None, budget: SearchBudget = None, trace=None,
+                  game: object = None) -> list:
+        """
+            Analyses all positions concurrently, results are in the same order as the input.
+            depth overrides the pool's search depth, positions left once the budget is exhausted get None.
+            Tablebase and cache hits, engine calls and skipped positions are counted in the (SearchTrace) trace.
+            Positions with the same game token (e.g. one per search) share the engines' hash tables
+        """
+        depth = depth or self.depth
+        verdicts = {}
+        pending = []
+        probed = 0
+        for fen in fen_positions:
+            key = normalize_fen(fen)
+            if key in verdicts:
+                continue
+            if self.tablebase is not None:
+                found, verdicts[key] = self.tablebase.verdict(fen)
+                if found:
+                    probed += 1
+                    continue
+            found, verdicts[key] = self.cache.get(fen, depth)
+            if not found:
+                pending.append(fen)
+
+        def analyse(fen):
+            return self._analyse(fen, depth, budget, game)
+
+        if len(pending) < 2 or self.size == 1:
+            analysed = [analyse(fen) for fen in pending]
+        else:
+            analysed = list(self._executor.map(analyse, pending))
+
+        analysed = [(fen, verdict) for fen, verdict in zip(pending, analysed) if verdict is not SKIPPED]
+        if trace is not None:
+            trace.count("tablebase_hits", probed)
+            trace.count("cache_hits", len(verdicts) - len(pending) - probed)
+            trace.count("engine_calls", len(analysed))
+            trace.count("engine_skipped", len(pending) - len(analysed))
+        self.cache.put_many(analysed, depth)
+        for fen, verdict in analysed:
+            verdicts[normalize_fen(fen)] = verdict
+
+        # Callers get their own copy, cached entries must stay untouched
+        results = []
+        for fen in fen_positions:
+            verdict = verdicts[normalize_fen(fen)]
+            results.append(dict(verdict) if verdict else None)
+        return results
+
+    def evaluation(self, fen_position: str, depth: int = None) -> dict:
+        """ Stockfish's {"type", "value"} evaluation of a position from the side to move's view (not cached) """
+        lines = self._search(fen_position, depth or self.depth)
+        if not lines:
+            return {"type": "cp", "value": 0}
+        if lines[0]["Mate"] is not None:
+            return {"type": "mate", "value": lines[0]["Mate"]}
+        return {"type": "cp", "value": lines[0]["Centipawn"]}
+
+    def lease(self) -> UciEngine:
+        """ Takes an idle engine, starting a new process while the pool is not full yet """
+        while True:
+            try:
+                engine = self._engines.get_nowait()
+            except queue.Empty:
+                if self._reserve():
+                    return self._start_engine()
+                engine = self._engines.get()
+            if engine is not None:
+                return engine
+            # None: an engine died and freed its slot (see _discard), start the replacement
+
+    def release(self, engine: UciEngine) -> None:
+        self._engines.put(engine)
+
+    def warm_up(self, wait: bool = False) -> threading.Thread:
+        """ Starts all remaining engines in a background thread """
+        def start_all():
+            while self._reserve():
+                self.release(self._start_engine())
+
+        thread = threading.Thread(target=start_all, name="engine-warm-up", daemon=True)
+        thread.start()
+        if wait:
+            thread.join()
+        return thread
+
+    @property
+    def started(self) -> int:
+        return self._started
+
+    def _reserve(self) -> bool:
+        with self._start_lock:
+            if self._started >= self.size:
+                return False
+            self._started += 1
+            return True
+
+    def _start_engine(self) -> UciEngine:
+        _start = time.perf_counter()
+        try:
+            return UciEngine(self.path)
+        except Exception:
+            self._discard()
+            raise
+        finally:
+            with self._start_lock:
+                self.startup_seconds += time.perf_counter() - _start
+
+    def _discard(self) -> None:
+        """ Frees the slot of an engine that is gone, a lease waiting for an idle engine starts a new one """
+        with self._start_lock:
+            self._started -= 1
+        self._engines.put(None)
+
+    def _search(self, fen_position: str, depth: int, game: object = None, **options) -> list:
+        engine = self.lease()
+        try:
+            lines = engine.search(fen_position, depth, game, **options)
+        except BaseException:
+            # A crashed engine, or one left half-way through a search, is replaced by the next lease
+            engine.process.kill()
+            engine.process.wait()
+            self._discard()
+            raise
+        self.release(engine)
+        return lines
+
+    def _analyse(self, fen_position: str, depth: int, budget: SearchBudget = None, game: object = None) -> dict:
+        if budget is not None and budget.exhausted:
+            return SKIPPED
+
+        lines = self._search(fen_position, depth, game)
+        if not lines:
+            return None
+        if budget is not None:
+            budget.spend(lines[0]["Nodes"])
+        return {"Move": lines[0]["Move"], "Centipawn": lines[0]["Centipawn"], "Mate": lines[0]["Mate"]}
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+        while not self._engines.empty():
+            engine = self._engines.get_nowait()
+            if engine is not None:
+                engine.quit()
+
+
+class AsyncEnginePool:
+    """
+        asyncio counterpart of EnginePool: one event loop drives up to size engine processes.
+
+        top_moves is a coroutine, every position gets its own task that leases an idle engine,
+        so the loop can generate and score further positions while the engines search.
+        A position that is already being searched (by any caller) is awaited instead of searched
+        twice. Verdicts share the EvalCache with the synchronous pool.
+
+        Engines belong to the event loop that started them, use (and close()) a pool within one loop.
+    """
+
+    def __init__(self, size: int = None, depth: int = 8, path: str = None, cache: EvalCache = None,
+                 tablebase: Tablebase = None) -> None:
+        self.size = size or os.cpu_count() or 1
+        self.depth = depth
+        self.path = path or stockfish_path
+        self.cache = cache if cache is not None else EvalCache()
+        self.tablebase = tablebase
+
+        self._engines = asyncio.Queue()
+        self._started = 0
+        # See EnginePool.startup_seconds
+        self.startup_seconds = 0.0
+        # (normalized FEN, depth) -> task of the search in flight
+        self._inflight = {}
+
+    async def top_moves(self, fen_positions: list, depth: int = None, budget: SearchBudget = None, trace=None,
+                        game: object = None) -> list:
+        """ See EnginePool.top_moves """
+        depth = depth or self.depth
+        verdicts = {}
+        pending = {}
+        own = set()
+        probed = 0
+        for fen in fen_positions:
+            key = normalize_fen(fen)
+            if key in verdicts or key in pending:
+                continue
+            if self.tablebase is not None:
+                found, verdicts[key] = self.tablebase.verdict(fen)
+                if found:
+                    probed += 1
+                    continue
+            found, verdicts[key] = self.cache.get(fen, depth)
+            if found:
+                continue
+            task = self._inflight.get((key, depth))
+            if task is None:
+                task = asyncio.ensure_future(self._analyse(fen, depth, budget, game))
+                self._inflight[key, depth] = task
+                task.add_done_callback(lambda _, flight=(key, depth): self._inflight.pop(flight, None))
+                own.add(key)
+            pending[key] = (fen, task)
+
+        # Shielded, other callers may wait for the same searches when this one is cancelled
+        analysed = await asyncio.gather(*(asyncio.shield(task) for _, task in pending.values()))
+        finished = []
+        for (key, (fen, _)), verdict in zip(pending.items(), analysed):
+            if verdict is SKIPPED:
+                continue
+            verdicts[key] = verdict
+            if key in own:
+                finished.append((fen, verdict))
+        if trace is not None:
+            trace.count("tablebase_hits", probed)
+            trace.count("cache_hits", len(verdicts) - len(pending) - probed)
+            trace.count("engine_calls", len(finished))
+            trace.count("engine_coalesced", len(pending) - len(own))
+            trace.count("engine_skipped", analysed.count(SKIPPED))
+        self.cache.put_many(finished, depth)
+
+        results = []
+        for fen in fen_positions:
+            verdict = verdicts[normalize_fen(fen)]
+            results.append(dict(verdict) if verdict else None)
+        return results
+
+    async def lease(self) -> AsyncUciEngine:
+        while True:
+            if not self._engines.empty():
+                engine = self._engines.get_nowait()
+            elif self._started < self.size:
+                self._started += 1
+                _start = time.perf_counter()
+                try:
+                    return await AsyncUciEngine.start(self.path)
+                except Exception:
+                    self._discard()
+                    raise
+                finally:
+                    self.startup_seconds += time.perf_counter() - _start
+            else:
+                engine = await self._engines.get()
+            if engine is not None:
+                return engine
+            # See EnginePool.lease
+
+    def _discard(self) -> None:
+        self._started -= 1
+        self._engines.put_nowait(None)
+
+    def release(self, engine: AsyncUciEngine) -> None:
+        self._engines.put_nowait(engine)
+
+    @property
+    def started(self) -> int:
+        return self._started
+
+    async def _search(self, fen_position: str, depth: int, game: object = None, **options) -> list:
+        engine = await self.lease()
+        try:
+            lines = await engine.search(fen_position, depth, game, **options)
+        except BaseException:
+            # A search cut off half-way leaves its output behind, the engine is not reused
+            self._discard()
+            if engine.process.returncode is None:
+                engine.process.kill()
+            await engine.process.wait()
+            raise
+        self.release(engine)
+        return lines
+
+    async def _analyse(self, fen_position: str, depth: int, budget: SearchBudget = None,
+                       game: object = None) -> dict:
+        if budget is not None and budget.exhausted:
+            return SKIPPED
+
+        lines = await self._search(fen_position, depth, game)
+        if not lines:
+            return None
+        if budget is not None:
+            budget.spend(lines[0]["Nodes"])
+        return {"Move": lines[0]["Move"], "Centipawn": lines[0]["Centipawn"], "Mate": lines[0]["Mate"]}
+
+    async def close(self) -> None:
+        """ Cancels the searches in flight and stops the engines """
+        tasks = list(self._inflight.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        while not self._engines.empty():
+            engine = self._engines.get_nowait()
+            if engine is not None:
+                await engine.quit()
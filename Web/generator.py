@@ -1,14 +1,19 @@
+import asyncio
+import heapq
 import time
 import math
-import random
+import weakref
+from typing import NamedTuple
 
 import chess
-from stockfish import Stockfish
 
-from heuristics import Heuristics
-from move_generator import MoveGenerator
-
-stockfish_path = "stockfish_14.1_win_x64_avx2/stockfish_14.1_win_x64_avx2.exe"
+from cache import EvalCache
+from engine_pool import AsyncEnginePool, EnginePool, SearchBudget
+from heuristics import Heuristics, parse_board
+from metrics import SearchTrace
+from move_generator import MoveGenerator, RetroBoard
+from node_store import NodeStore
+from tablebase import Tablebase
 
 
 # Most of this cell is rip-off from python-chess library
@@ -16,6 +21,8 @@ stockfish_path = "stockfish_14.1_win_x64_avx2/stockfish_14.1_win_x64_avx2.exe"
 
 
 class State:
+    __slots__ = ("fen", "parent", "children")
+
     def __init__(self, fen: str, parent: str = None, move: str = None) -> None:
         self.fen = fen
         self.parent = parent
@@ -37,9 +44,90 @@ class State:
         return self.__str__()
 
 
+class PuzzleRow(NamedTuple):
+    """
+        A position that passed the filters of its depth.
+
+        move: forward move that the engine found best, heuristics: (heuristics dict, total),
+        node: index in the search's NodeStore, line: forward moves from fen back to the searched position
+    """
+    move: str
+    fen: str
+    centipawn: float
+    heuristics: tuple
+    node: int = None
+    line: tuple = ()
+
+
+def puzzle_record(move_type: str, depth: int, row: PuzzleRow) -> dict:
+    """ JSON friendly form of a puzzle row """
+    heuristics, total = row.heuristics
+    centipawn, mate = row.centipawn, None
+    if abs(centipawn) == math.inf:
+        mate, centipawn = (1 if centipawn > 0 else -1), None
+    return {
+        "type": move_type,
+        "depth": depth,
+        "fen": row.fen,
+        "move": row.move,
+        "line": list(row.line),
+        "centipawn": centipawn,
+        "mate": mate,
+        "heuristics": {name: val for name, (flag, val) in heuristics.items() if flag},
+        "score": total,
+    }
+
+
+# Centipawns at which the engine eval counts fully towards the frontier priority
+EVAL_SCALE = 1000
+
+
+def frontier_priority(row: PuzzleRow) -> float:
+    """ Heuristic total plus the (capped) engine eval of a puzzle row """
+    return row.heuristics[1] + min(abs(row.centipawn), EVAL_SCALE) / EVAL_SCALE
+
+
+# Candidate filters of a search layer, cheapest first. Every stage only sees the survivors of the previous one:
+#   structure: drops dead draws (insufficient material), the engine scores them 0 which is never a puzzle
+#   heuristics: scores the candidates, below heuristic_depth a total of min_heuristic is needed
+#   probe: engine search at probe_depth, the move must be its best one (skipped without a probe depth)
+#   engine: full-depth engine verdict, the move must be the best one
+FILTER_STAGES = ("structure", "heuristics", "probe", "engine")
+
+
+class SearchContext(NamedTuple):
+    """
+        Immutable parameters of a single puzzle search, every request builds its own.
+
+        beam: children kept per move type and parent
+        frontier_width: positions kept for the next depth, the best ones by frontier_priority (None: all)
+        time_budget/node_budget: wall-clock seconds and engine nodes the search may spend (None: no limit)
+        probe_depth: engine depth of the pruning check, only its survivors are verified at full depth
+        stages: order of the candidate filters (see FILTER_STAGES), the engine stage is required, a probe precedes it
+        min_heuristic/heuristic_depth: heuristic total a candidate needs at depths below heuristic_depth
+    """
+    fen: str
+    max_depth: int = 6
+    beam: int = 5
+    frontier_width: int = 64
+    time_budget: float = None
+    node_budget: int = None
+    probe_depth: int = None
+    stages: tuple = FILTER_STAGES
+    min_heuristic: float = 0.1
+    heuristic_depth: int = 3
+
+
 class GameState:
+    """
+        Puzzle search over shared engines, move generator and heuristics.
 
-    def __init__(self, initial_state: str = None) -> None:
+        get_puzzles keeps all of its search state local, so one GameState can serve many
+        threads at once when each of them passes its own SearchContext.
+    """
+
+    def __init__(self, initial_state: str = None, pool_size: int = None, cache: EvalCache = None,
+                 engines: EnginePool = None, tablebase: Tablebase = None) -> None:
 
         self.initial = None
         self.board = None
@@ -47,10 +135,15 @@ class GameState:
         if initial_state:
             self.update_initial(initial_state)
 
-        self.stockfish = Stockfish(stockfish_path)
-        self.stockfish.set_depth(8)
+        # Long-lived Stockfish processes, the candidates of a BFS layer are analysed concurrently.
+        # Verdicts are kept in the cache across calls to get_puzzles, endgames come from the tablebase
+        if engines is None:
+            engines = EnginePool(size=pool_size, depth=8, cache=cache, tablebase=tablebase)
+        self.engines = engines
+        # AsyncEnginePool of every event loop that searched, started on first use (see async_engines)
+        self._async_engines = weakref.WeakKeyDictionary()
 
-        self.heur = Heuristics()
+        self.heur = Heuristics(engines=self.engines)
         self.move_generator = MoveGenerator()
 
     @property
@@ -82,112 +175,452 @@ class GameState:
         self.board = self.board.mirror()
         self.display_board()
 
-    def get_puzzles(self, max_depth=6):
-        _start = time.time()
-        total_states = 0
-
-        position = self.initial.fen
-
-        trim = True
-        queue = [position]
+    def get_puzzles(self, max_depth=6, progress=None, context: SearchContext = None, trace: SearchTrace = None):
+        """
+            Breadth-first retro-search from context.fen (the initial position when no context is given).
+            progress(depth, results) is called after every depth, it may raise to abort the search.
+            Pass a SearchTrace to get the per-depth timings and counters of this search
+        """
+        if context is None:
+            context = SearchContext(self.initial.fen, max_depth)
 
-        default_dict = {
+        results = {
             "legal": [],
             "pawn": [],
             "uncapture": [],
         }
 
+        trace = trace if trace is not None else SearchTrace()
+        try:
+            for i, found in self.search_layers(context, trace=trace):
+                for move_type, rows in found.items():
+                    results[move_type].extend((i, row) for row in rows)
+                if progress:
+                    progress(i, results)
+        finally:
+            trace.finish()
+        return results
+
+    async def get_puzzles_async(self, max_depth=6, progress=None, context: SearchContext = None,
+                                trace: SearchTrace = None, engines: AsyncEnginePool = None):
+        """
+            get_puzzles for an event loop: the engines search while the next candidates are generated
+            and scored. Without an AsyncEnginePool the one of the running loop is used (see async_engines)
+        """
+        if context is None:
+            context = SearchContext(self.initial.fen, max_depth)
+        if engines is None:
+            engines = self.async_engines()
+
         results = {
             "legal": [],
             "pawn": [],
             "uncapture": [],
         }
 
-        for i in range(1, max_depth):
-            count = 0
-            temp_queue = []
-            print("Depth: ", i)
-            while queue:
-                position = queue.pop()
-                move_dict = self.move_generator.get_all_moves(position)
-                self.stockfish.set_fen_position(position)
-                filtered = {"legal": [], "pawn": [], "uncapture": []}
-                centis = {"legal": [], "pawn": [], "uncapture": []}
-                heurs = {"legal": [], "pawn": [], "uncapture": []}
-
-                player = "w" if position.split()[1] == "b" else "b"
-
-                for move_type, moves in move_dict.items():
-                    for move, fen in moves:
-                        # move = move[2:] + move[:2]
-                        fen = fen.split()
-                        fen[1] = "b" if fen[1] == "w" else "w"
-                        fen = " ".join(fen)
-
-                        self.stockfish.set_fen_position(fen)
-                        top_moves = self.stockfish.get_top_moves(1)
-                        if move in top_moves[0]["Move"]:
-                            count += 1
-                            val = self.heur.get_all_heuristics(fen)
-
-                            if not top_moves[0]["Centipawn"]:
-                                if not top_moves[0]["Mate"]:
-                                    continue
-                                top_moves[0]["Centipawn"] = math.inf * top_moves[0]["Mate"]
-
-                            filtered[move_type].append((move, fen, top_moves[0]["Centipawn"], val))
-                            centis[move_type].append(top_moves[0]["Centipawn"])
-                            heurs[move_type].append(val[1])
-
-                position = position.split()
-                position[1] = "w" if position[1] == "b" else "b"
-
-                player_multiplier = 1 if player == "w" else -1
-
-                for move_type in default_dict.keys():
-                    temp_filtered = filtered[move_type]
-                    if centis[move_type]:
-                        if player_multiplier * math.inf in centis[move_type]:
-                            temp_filtered = [state for state in temp_filtered if
-                                             state[2] == player_multiplier * math.inf]
-                        else:
-                            centis[move_type].sort()
-                            if player_multiplier == 1:
-                                centi_threshold = centis[move_type][-1] * 0.8
-                            else:
-                                centi_threshold = centis[move_type][0] * 0.8
-                            centi_threshold = 0
-                            if abs(centi_threshold) != math.inf:
-                                temp_filtered = [state for state in temp_filtered
-                                                 if abs(state[2]) > abs(centi_threshold)]
-                    if heurs[move_type]:
-                        heurs[move_type].sort()
-                        heur_threshold = heurs[move_type][-1] * 0.8 * 0
-                    else:
-                        heur_threshold = 0
-                    if i < 3:
-                        temp_filtered = [state for state in temp_filtered if state[3][1] > 0.1]
-                    if len(temp_filtered) > 5 and trim:
-                        temp_filtered.sort(key=lambda x: x[3][1])
-                        temp_filtered = temp_filtered[:5]
-                    total_states += len(temp_filtered)
-                    if temp_filtered and i > 1 and i % 2 == 1:
-                        for row in temp_filtered:
+        trace = trace if trace is not None else SearchTrace()
+        try:
+            async for i, found in self.search_layers_async(context, engines, trace=trace):
+                for move_type, rows in found.items():
+                    results[move_type].extend((i, row) for row in rows)
+                if progress:
+                    progress(i, results)
+        finally:
+            trace.finish()
+
+        return results
+
+    def async_engines(self) -> AsyncEnginePool:
+        """
+            AsyncEnginePool of the running event loop, created on first use with the size, engine cache
+            and tablebase of the synchronous pool and kept for later searches of the loop. Its engines
+            are started lazily, stop them with close_async_engines before the loop is closed
+        """
+        loop = asyncio.get_running_loop()
+        engines = self._async_engines.get(loop)
+        if engines is None:
+            engines = self._async_engines[loop] = AsyncEnginePool(
+                size=self.engines.size, depth=self.engines.depth, path=self.engines.path,
+                cache=self.engines.cache, tablebase=self.engines.tablebase)
+        return engines
+
+    async def close_async_engines(self) -> None:
+        """ Stops the engines of the running loop's AsyncEnginePool """
+        engines = self._async_engines.pop(asyncio.get_running_loop(), None)
+        if engines is not None:
+            await engines.close()
+
+    def iter_puzzles(self, fen: str, max_depth: int = 6, limit: int = None, time_budget: float = None):
+        """
+            Yields puzzle records (see puzzle_record) as soon as a depth is finished, best scores first.
+            Stops after limit puzzles or once time_budget seconds are spent (engine calls and depths
+            are cut off at the deadline, see SearchContext.time_budget)
+        """
+        found = 0
+
+        layers = self.search_layers(SearchContext(fen, max_depth, time_budget=time_budget))
+        try:
+            for i, rows in layers:
+                records = [puzzle_record(move_type, i, row) for move_type, type_rows in rows.items()
+                           for row in type_rows]
+                for record in sorted(records, key=lambda record: record["score"], reverse=True):
+                    yield record
+                    found += 1
+                    if limit is not None and found >= limit:
+                        return
+        finally:
+            layers.close()
+
+    def get_puzzles_budgeted(self, fen: str, time_budget: float = None, node_budget: int = None,
+                             max_depth: int = 10, beam: int = 5, frontier_width: int = 64, probe_depth: int = 4):
+        """
+            Searches as deep as the budget allows, then widens the beam and the frontier while budget remains.
+            Every round reuses the cached verdicts of the previous ones. Returns the get_puzzles results
+        """
+        budget = SearchBudget(time_budget, node_budget)
+        trace = SearchTrace()
+        results = {"legal": [], "pawn": [], "uncapture": []}
+        seen = set()
+
+        while not budget.exhausted:
+            context = SearchContext(fen, max_depth, beam, frontier_width, time_budget=time_budget,
+                                    node_budget=node_budget, probe_depth=probe_depth)
+            budget.trimmed = False
+            for i, found in self.search_layers(context, budget, trace):
+                for move_type, rows in found.items():
+                    for row in rows:
+                        if row[1] not in seen:
+                            seen.add(row[1])
                             results[move_type].append((i, row))
-                    temp_filtered = [move[1] for move in temp_filtered]
-                    temp_queue.extend(temp_filtered)
-                    filtered[move_type] = temp_filtered
-
-            print(f"Total good puzzles at depth: {i} are {count}")
-            queue = temp_queue
-        print(time.time() - _start)
-
-        puzzles = []
-        for move_type in results:
-            temp = random.choices(results[move_type], k=min(len(results[move_type]), 2))
-            puzzles.extend([puzzle[1][1] for puzzle in temp if puzzle[0] > 2])
+
+            if time_budget is None and node_budget is None or not budget.trimmed:
+                break
+            beam *= 2
+            frontier_width *= 2
+
+        trace.finish()
         return results
 
+    def search_layers(self, context: SearchContext, budget: SearchBudget = None, trace: SearchTrace = None):
+        """
+            Runs the search one depth at a time, yields (depth, {move type: new puzzle rows}).
+            A depth only expands as many of the best parents as the remaining time is expected to cover.
+            Stage timings and counters go to the trace (and from there to the metrics registry),
+            a trace passed in is finished by the caller
+        """
+        if trace is not None:
+            yield from self._search_layers(context, budget, trace)
+            return
+
+        trace = SearchTrace()
+        try:
+            yield from self._search_layers(context, budget, trace)
+        finally:
+            trace.finish()
+
+    def _search_layers(self, context: SearchContext, budget: SearchBudget, trace: SearchTrace):
+        if budget is None:
+            budget = SearchBudget(context.time_budget, context.node_budget)
+        seconds_per_parent = 0
+
+        board = RetroBoard(context.fen)
+        # Every generated position, the frontier only holds node indices into it
+        nodes = NodeStore()
+        queue = [nodes.add(board)]
+        # Packed keys of the positions that already were in a frontier, they are not searched again
+        seen = {board.key()}
+
+        for i in range(1, context.max_depth):
+            queue = self._fit_layer(queue, seconds_per_parent, budget)
+            if not queue or budget.exhausted:
+                return
+            _layer_start = time.time()
+            _startup = self.engines.startup_seconds
+            parents = len(queue)
+            trace.start_layer(i)
+            trace.count("nodes_expanded", parents)
+
+            # Expand the whole layer first so that all of its candidates are analysed in one batch
+            expanded = [self._expand(parent, board, nodes, trace) for parent in reversed(queue)]
+            candidates = [(move, fen) for _, move_dict in expanded for moves in move_dict.values()
+                          for move, fen, _ in moves]
+            trace.count("candidates", len(candidates))
+
+            # Verdicts and heuristics come back in the order the candidates were generated
+            verdicts, heuristics = self._run_cascade(self._cascade(i, context, candidates, trace), budget, trace)
+
+            found, queue = self._select(i, context, budget, trace, expanded, verdicts, heuristics, nodes, seen)
+            trace.end_layer()
+            seconds_per_parent = self._seconds_per_parent(_layer_start, self.engines.startup_seconds - _startup,
+                                                          parents)
+            yield i, found
+
+    async def search_layers_async(self, context: SearchContext, engines: AsyncEnginePool,
+                                  budget: SearchBudget = None, trace: SearchTrace = None):
+        """
+            search_layers on an AsyncEnginePool. The candidates of every parent are sent to the engines
+            as soon as it is expanded, the heuristics of a parent are computed while the engines still
+            search the candidates of the following ones. Yields the same layers as search_layers
+        """
+        own_trace = trace is None
+        trace = SearchTrace() if own_trace else trace
+        if budget is None:
+            budget = SearchBudget(context.time_budget, context.node_budget)
+        seconds_per_parent = 0
+
+        board = RetroBoard(context.fen)
+        nodes = NodeStore()
+        queue = [nodes.add(board)]
+        seen = {board.key()}
+
+        try:
+            for i in range(1, context.max_depth):
+                queue = self._fit_layer(queue, seconds_per_parent, budget)
+                if not queue or budget.exhausted:
+                    return
+                _layer_start = time.time()
+                _startup = engines.startup_seconds
+                parents = len(queue)
+                trace.start_layer(i)
+                trace.count("nodes_expanded", parents)
+
+                expanded = []
+                searches = []
+                for parent in reversed(queue):
+                    player, move_dict = self._expand(parent, board, nodes, trace)
+                    candidates = [(move, fen) for moves in move_dict.values() for move, fen, _ in moves]
+                    trace.count("candidates", len(candidates))
+                    expanded.append((player, move_dict))
+                    searches.append(asyncio.ensure_future(self._run_cascade_async(
+                        self._cascade(i, context, candidates, trace), engines, budget, trace)))
+                    # Lets the new tasks hand their positions to idle engines before the next expansion
+                    await asyncio.sleep(0)
+
+                verdicts = []
+                heuristics = []
+                try:
+                    for search in searches:
+                        # Only the time spent waiting for the engines, the rest overlaps with them
+                        with trace.stage("engine"):
+                            parent_verdicts, parent_heuristics = await search
+                        verdicts.extend(parent_verdicts)
+                        heuristics.extend(parent_heuristics)
+                finally:
+                    for search in searches:
+                        search.cancel()
+
+                found, queue = self._select(i, context, budget, trace, expanded, verdicts, heuristics, nodes, seen)
+                trace.end_layer()
+                seconds_per_parent = self._seconds_per_parent(_layer_start, engines.startup_seconds - _startup,
+                                                              parents)
+                yield i, found
+        finally:
+            if own_trace:
+                trace.finish()
+
+    @staticmethod
+    def _fit_layer(queue: list, seconds_per_parent: float, budget: SearchBudget) -> list:
+        """ The best parents of the queue (the last ones, see _select) that the remaining time is expected to cover """
+        if seconds_per_parent * len(queue) <= budget.remaining_time:
+            return queue
+        budget.trimmed = True
+        fit = int(budget.remaining_time / seconds_per_parent)
+        return queue[len(queue) - fit:]
+
+    @staticmethod
+    def _seconds_per_parent(layer_start: float, startup_seconds: float, parents: int) -> float:
+        """ Time a layer took per expanded parent, without the engines started during it """
+        return max(time.time() - layer_start - startup_seconds, 0) / parents
+
+    def _expand(self, parent: int, board: RetroBoard, nodes: NodeStore, trace: SearchTrace):
+        """
+            Retro-children of a node as (player who made their moves, {move type: [(move, fen, node)]}).
+            The parent is set up on the shared board, its children are taken back and restored in place
+        """
+        nodes.restore(parent, board)
+        move_dict = {"legal": [], "pawn": [], "uncapture": []}
+        for retro in self.move_generator.children(board, trace):
+            node = nodes.add(board, parent, retro.move)
+            move_dict[retro.move_type].append((retro.uci(), board.fen(), node))
+        # The children were played by the player who is not to move in the parent
+        return not board.turn, move_dict
+
+    def _cascade(self, i: int, context: SearchContext, candidates: list, trace: SearchTrace):
+        """
+            Runs the filter stages of the context over the (move, fen) candidates of depth i, rejections are
+            counted as rejected_<stage>. Yields (fens, depth) engine requests and has to be sent their verdicts
+            (see _run_cascade). Returns the verdicts and heuristics per candidate, None for the rejected ones
+        """
+        if "engine" not in context.stages:
+            raise ValueError("the engine filter stage is required")
+        if "probe" in context.stages and context.stages.index("probe") > context.stages.index("engine"):
+            # The shallow probe verdict would replace the full-depth one
+            raise ValueError("the probe filter stage has to come before the engine stage")
+        verdicts = [None] * len(candidates)
+        heuristics = [None] * len(candidates)
+        alive = list(range(len(candidates)))
+
+        for stage in context.stages:
+            before = len(alive)
+            if stage == "structure":
+                with trace.stage("structure"):
+                    alive = [index for index in alive
+                             if not parse_board(candidates[index][1]).is_insufficient_material()]
+            elif stage == "heuristics":
+                # From heuristic_depth on the stage can not reject anything, the survivors are scored below
+                if i >= context.heuristic_depth:
+                    continue
+                # Positions that can not reach the threshold are left unscored (None)
+                threshold = context.min_heuristic
+                with trace.stage("heuristics"):
+                    scores = self.heur.get_all_heuristics_batch([candidates[index][1] for index in alive],
+                                                                threshold=threshold)
+                for index, score in zip(alive, scores):
+                    heuristics[index] = score
+                alive = [index for index in alive if heuristics[index] is not None and heuristics[index][1] > threshold]
+            elif stage in ("probe", "engine"):
+                if stage == "probe" and not context.probe_depth:
+                    continue
+                depth = context.probe_depth if stage == "probe" else None
+                found = yield [candidates[index][1] for index in alive], depth
+                for index, top_move in zip(alive, found):
+                    verdicts[index] = top_move
+                alive = [index for index in alive
+                         if verdicts[index] and candidates[index][0] in verdicts[index]["Move"]]
+            else:
+                raise ValueError(f"unknown filter stage: {stage}")
+            trace.count(f"rejected_{stage}", before - len(alive))
+
+        survivors = set(alive)
+        verdicts = [top_move if index in survivors else None for index, top_move in enumerate(verdicts)]
+        # Survivors are always scored, also when the heuristics stage is left out
+        unscored = [index for index in alive if heuristics[index] is None]
+        if unscored:
+            with trace.stage("heuristics"):
+                scores = self.heur.get_all_heuristics_batch([candidates[index][1] for index in unscored])
+            for index, score in zip(unscored, scores):
+                heuristics[index] = score
+        trace.count("best_moves", len(alive))
+        return verdicts, heuristics
+
+    def _run_cascade(self, cascade, budget: SearchBudget, trace: SearchTrace) -> tuple:
+        """ Answers the engine requests of a _cascade with the engine pool, returns its result """
+        try:
+            fens, depth = next(cascade)
+            while True:
+                # Engines keep their hash for the positions of one search (the budget is unique to it)
+                with trace.stage("engine"):
+                    found = self.engines.top_moves(fens, depth=depth, budget=budget, trace=trace, game=budget)
+                fens, depth = cascade.send(found)
+        except StopIteration as stop:
+            return stop.value
+
+    async def _run_cascade_async(self, cascade, engines: AsyncEnginePool, budget: SearchBudget,
+                                 trace: SearchTrace) -> tuple:
+        """ _run_cascade on an AsyncEnginePool """
+        try:
+            fens, depth = next(cascade)
+            while True:
+                found = await engines.top_moves(fens, depth=depth, budget=budget, trace=trace, game=budget)
+                fens, depth = cascade.send(found)
+        except StopIteration as stop:
+            return stop.value
+
+    def _select(self, i: int, context: SearchContext, budget: SearchBudget, trace: SearchTrace, expanded: list,
+                verdicts: list, heuristics: list, nodes: NodeStore, seen: set):
+        """
+            Filters the expanded candidates per parent and move type (verdicts and heuristics per candidate,
+            see _cascade). Returns the puzzles found at depth i and the queue of the next depth
+        """
+        default_dict = {
+            "legal": [],
+            "pawn": [],
+            "uncapture": [],
+        }
+        trim = True
+        total_states = 0
+        order = 0
+        # Min-heap of (priority, -order, node), the worst position is dropped when it is full
+        frontier = []
+        found = {move_type: [] for move_type in default_dict}
+
+        heuristics = iter(heuristics)
+        verdicts = iter(verdicts)
+
+        _filter_start = time.perf_counter()
+
+        for player, move_dict in expanded:
+            filtered = {"legal": [], "pawn": [], "uncapture": []}
+            centis = {"legal": [], "pawn": [], "uncapture": []}
+            heurs = {"legal": [], "pawn": [], "uncapture": []}
+
+            for move_type, moves in move_dict.items():
+                for move, fen, node in moves:
+                    top_move = next(verdicts)
+                    val = next(heuristics)
+                    if top_move and move in top_move["Move"]:
+                        if not top_move["Centipawn"]:
+                            if not top_move["Mate"]:
+                                continue
+                            top_move["Centipawn"] = math.inf * top_move["Mate"]
+
+                        filtered[move_type].append(PuzzleRow(move, fen, top_move["Centipawn"], val, node))
+                        centis[move_type].append(top_move["Centipawn"])
+                        heurs[move_type].append(val[1])
+
+            player_multiplier = 1 if player == chess.WHITE else -1
+
+            for move_type in default_dict.keys():
+                temp_filtered = filtered[move_type]
+                if centis[move_type]:
+                    if player_multiplier * math.inf in centis[move_type]:
+                        temp_filtered = [state for state in temp_filtered if
+                                         state[2] == player_multiplier * math.inf]
+                    else:
+                        centis[move_type].sort()
+                        if player_multiplier == 1:
+                            centi_threshold = centis[move_type][-1] * 0.8
+                        else:
+                            centi_threshold = centis[move_type][0] * 0.8
+                        centi_threshold = 0
+                        if abs(centi_threshold) != math.inf:
+                            temp_filtered = [state for state in temp_filtered
+                                             if abs(state[2]) > abs(centi_threshold)]
+                if heurs[move_type]:
+                    heurs[move_type].sort()
+                    heur_threshold = heurs[move_type][-1] * 0.8 * 0
+                else:
+                    heur_threshold = 0
+                trace.count("pruned_threshold", len(filtered[move_type]) - len(temp_filtered))
+                if len(temp_filtered) > context.beam and trim:
+                    temp_filtered.sort(key=lambda x: x[3][1], reverse=True)
+                    trace.count("pruned_beam", len(temp_filtered) - context.beam)
+                    temp_filtered = temp_filtered[:context.beam]
+                    budget.trimmed = True
+                total_states += len(temp_filtered)
+                if temp_filtered and i > 1 and i % 2 == 1:
+                    found[move_type].extend(row._replace(line=tuple(nodes.line(row.node)))
+                                            for row in temp_filtered)
+
+                for row in temp_filtered:
+                    key = nodes.key(row.node)
+                    if key in seen:
+                        trace.count("duplicates")
+                        continue
+                    seen.add(key)
+                    order += 1
+                    priority = nodes.scores[row.node] = frontier_priority(row)
+                    heapq.heappush(frontier, (priority, -order, row.node))
+                    if context.frontier_width is not None and len(frontier) > context.frontier_width:
+                        heapq.heappop(frontier)
+                        trace.count("pruned_frontier")
+                        budget.trimmed = True
+                filtered[move_type] = [move[1] for move in temp_filtered]
+
+        trace.add_time("filter", time.perf_counter() - _filter_start)
+        # Best position last, queue.pop() expands it first
+        return found, [node for _, _, node in sorted(frontier)]
+
 
 if __name__ == '__main__':
     import time
@@ -1,9 +1,121 @@
 
+import math
+import time
 from collections import Counter
-from stockfish import Stockfish
-from move_generator import MoveGenerator
 
-stockfish_path = "stockfish_14.1_win_x64_avx2/stockfish_14.1_win_x64_avx2.exe"
+import chess
+import numpy as np
+from numpy import ndarray
+
+from engine_pool import EnginePool
+
+# Piece planes of the batch encoding: white pieces first, then black (python-chess square order, a1 = 0)
+PIECE_PLANES = "PNBRQKpnbrqk"
+PLANE_INDEX = {piece: index for index, piece in enumerate(PIECE_PLANES)}
+
+# Ray directions as (file, rank) steps: straight lines first, then diagonals
+DIRECTIONS = [(0, 1), (0, -1), (1, 0), (-1, 0), (1, 1), (-1, 1), (1, -1), (-1, -1)]
+
+
+def _ray_table() -> ndarray:
+    """ (64, 8, 7) squares along each ray, padded with 64 (off the board) """
+    rays = np.full((64, 8, 7), 64, dtype=np.intp)
+    for square in range(64):
+        for direction, (file_step, rank_step) in enumerate(DIRECTIONS):
+            file, rank = chess.square_file(square), chess.square_rank(square)
+            for step in range(7):
+                file, rank = file + file_step, rank + rank_step
+                if not (0 <= file < 8 and 0 <= rank < 8):
+                    break
+                rays[square, direction, step] = chess.square(file, rank)
+    return rays
+
+
+def _attack_table(bitboards) -> ndarray:
+    """ (64, 64) boolean attack table from python-chess attack bitboards """
+    table = np.zeros((64, 64), dtype=bool)
+    for square in range(64):
+        table[square, list(chess.SquareSet(bitboards[square]))] = True
+    return table
+
+
+RAYS = _ray_table()
+KNIGHT_ATTACKS = _attack_table(chess.BB_KNIGHT_ATTACKS)
+# Indexed by [is_white]
+PAWN_ATTACKS = np.stack([_attack_table(chess.BB_PAWN_ATTACKS[chess.BLACK]),
+                         _attack_table(chess.BB_PAWN_ATTACKS[chess.WHITE])])
+# Squares on the lines of a bishop, rook and queen on an empty board
+LINES = np.zeros((3, 64, 65), dtype=bool)
+LINES[0, np.arange(64)[:, None], RAYS[:, 4:].reshape(64, -1)] = True
+LINES[1, np.arange(64)[:, None], RAYS[:, :4].reshape(64, -1)] = True
+LINES = LINES[:, :, :64]
+LINES[2] = LINES[0] | LINES[1]
+
+# [square][direction] bitboard of the squares of each ray, directions that go up the square index are
+# scanned from the least significant bit (nearest square first), the others from the most significant
+RAY_MASKS = [[sum(chess.BB_SQUARES[target] for target in ray if target < 64) for ray in rays] for rays in RAYS]
+ASCENDING_DIRECTIONS = {0, 2, 4, 5}
+STRAIGHT, DIAGONAL = range(0, 4), range(4, 8)
+# Directions along which each piece type pins
+PINNER_DIRECTIONS = {
+    chess.ROOK: STRAIGHT,
+    chess.BISHOP: DIAGONAL,
+    chess.QUEEN: range(8),
+}
+
+# FEN piece symbol -> (piece type, is white)
+PIECE_SYMBOLS = {symbol: (chess.PIECE_SYMBOLS.index(symbol.lower()), symbol.isupper()) for symbol in PIECE_PLANES}
+
+
+def parse_board(fen_position: str) -> chess.Board:
+    """
+        Piece placement and side to move of a FEN, without chess.Board's parsing and validation overhead.
+        Castling rights and en passant are left out, they never make a capture
+    """
+    placement, turn = fen_position.split(" ", 2)[:2]
+    masks = [0] * 7
+    colors = [0, 0]
+    square = 56
+    for char in placement:
+        if char == "/":
+            square -= 16
+        elif char in "12345678":
+            square += int(char)
+        else:
+            piece_type, color = PIECE_SYMBOLS[char]
+            masks[piece_type] |= chess.BB_SQUARES[square]
+            colors[color] |= chess.BB_SQUARES[square]
+            square += 1
+
+    board = chess.Board(None)
+    board.pawns, board.knights, board.bishops, board.rooks, board.queens, board.kings = masks[1:]
+    board.occupied_co = colors
+    board.occupied = colors[0] | colors[1]
+    board.turn = turn == "w"
+    return board
+
+
+
+class HeuristicRegistry:
+    """
+        Heuristic functions by name with their measured cost, a moving average of seconds per position.
+        Single positions and batches (see Heuristics.score_batch) are timed separately.
+        ordered() lists them cheapest first, the lazy evaluation of Heuristics runs them in that order
+    """
+    SMOOTHING = 0.1
+
+    def __init__(self, functions: dict) -> None:
+        self.functions = dict(functions)
+        self.costs = {(name, batch): 0.0 for name in functions for batch in (False, True)}
+
+    def ordered(self, names: list = None, batch: bool = False) -> list:
+        return sorted(names if names is not None else self.functions, key=lambda name: self.costs[name, batch])
+
+    def record(self, name: str, seconds: float, positions: int = 1, batch: bool = False) -> None:
+        if not positions:
+            return
+        cost, seconds = self.costs[name, batch], seconds / positions
+        self.costs[name, batch] = seconds if not cost else cost + self.SMOOTHING * (seconds - cost)
 
 
 class Heuristics:
@@ -12,7 +124,7 @@ class Heuristics:
     FORK_THRESHOLD = 0.05
     SACRIFICE_THRESHOLD = 0.0
 
-    def __init__(self, values: dict = None) -> None:
+    def __init__(self, values: dict = None, engines: EnginePool = None) -> None:
         # Defining initial material value (weights from AlphaZero)
         self.values = {
             'p': 1.00,
@@ -25,7 +137,10 @@ class Heuristics:
         if values:
             self.values = values
 
-        self.map_fen = {alpha: num for alpha, num in zip("abcdefgh", range(8))}
+        # Pins and forks weigh the king as the most valuable target
+        self.attack_values = dict(self.values, k=15)
+        # attack_values indexed by piece type
+        self.type_values = [0] + [self.attack_values[symbol] for symbol in chess.PIECE_SYMBOLS[1:]]
 
         # List of all constants
         # Through previous literature, updated with AlphaZero weights
@@ -40,191 +155,37 @@ class Heuristics:
             "Pin": self.pin,
             "Fork": self.fork,
         }
+        self.registry = HeuristicRegistry(self.heuristic_functions)
 
-        self.move_generator = MoveGenerator()
-        self.stockfish = Stockfish(stockfish_path)
-        self.stockfish.set_depth(10)
-
-    def get_piece_pos(self, piece):
-        col, row = piece
-        row = 8 - int(row)
-        col = self.map_fen[col]
-
-        return row, col
-
-    def check_straight_lines(self, board, row, column, friendly_pieces, values):
-        # vertical
-
-        pins = []
-        the_value = -100
-        for target_row in range(row - 1, -1, -1):
-            if board[target_row][column] in friendly_pieces:
-                break
-            if board[target_row][column] == '-':
-                continue
-            if the_value == -100:
-                the_value = values[board[target_row][column].lower()]
-            else:
-                new_value = values[board[target_row][column].lower()]
-                if new_value > the_value:
-                    pins.append(new_value + the_value)
-                    break
-        the_value = -100
-        for target_row in range(row + 1, 8):
-            if board[target_row][column] in friendly_pieces:
-                break
-            if board[target_row][column] == '-':
-                continue
-            if the_value == -100:
-                the_value = values[board[target_row][column].lower()]
-            else:
-                new_value = values[board[target_row][column].lower()]
-                if new_value > the_value:
-                    pins.append(new_value + the_value)
-                    break
-
-        # horizontal
-        the_value = -100
-        for target_column in range(column - 1, -1, -1):
-            if board[row][target_column] in friendly_pieces:
-                break
-            if board[row][target_column] == '-':
-                continue
-            if the_value == -100:
-                the_value = values[board[row][target_column].lower()]
-            else:
-                new_value = values[board[row][target_column].lower()]
-                if new_value > the_value:
-                    pins.append(new_value + the_value)
-                    break
-        the_value = -100
-        for target_column in range(column + 1, 8):
-            if board[row][target_column] in friendly_pieces:
-                break
-            if board[row][target_column] == '-':
-                continue
-            if the_value == -100:
-                the_value = values[board[row][target_column].lower()]
-            else:
-                new_value = values[board[row][target_column].lower()]
-                if new_value > the_value:
-                    pins.append(new_value + the_value)
-                    break
-
-        return pins
-
-    def check_diagonal_lines(self, board, row, column, friendly_pieces, values):
-        pins = []
-        # upper left
-        target_row = row - 1
-        target_column = column - 1
-        the_value = -100
-        while target_row >= 0 and target_column >= 0:
-            if board[target_row][target_column] in friendly_pieces:
-                break
-            if board[target_row][target_column] == '-':
-                target_row = target_row - 1
-                target_column = target_column - 1
-                continue
-            if the_value == -100:
-                the_value = values[board[target_row][target_column].lower()]
-            else:
-                new_value = values[board[target_row][target_column].lower()]
-                if new_value > the_value:
-                    pins.append(new_value + the_value)
-                    break
-            target_row = target_row - 1
-            target_column = target_column - 1
-
-        # upper right
-        target_row = row - 1
-        target_column = column + 1
-        the_value = -100
-        while target_row >= 0 and target_column <= 7:
-            if board[target_row][target_column] in friendly_pieces:
-                break
-            if board[target_row][target_column] == '-':
-                target_row = target_row - 1
-                target_column = target_column + 1
-                continue
-            if the_value == -100:
-                the_value = values[board[target_row][target_column].lower()]
-            else:
-                new_value = values[board[target_row][target_column].lower()]
-                if new_value > the_value:
-                    pins.append(new_value + the_value)
-                    break
-            target_row = target_row - 1
-            target_column = target_column + 1
-
-        # lower left
-        target_row = row + 1
-        target_column = column - 1
-        the_value = -100
-        while target_row <= 7 and target_column >= 0:
-            if board[target_row][target_column] in friendly_pieces:
-                break
-            if board[target_row][target_column] == '-':
-                target_row = target_row + 1
-                target_column = target_column - 1
-                continue
-            if the_value == -100:
-                the_value = values[board[target_row][target_column].lower()]
-            else:
-                new_value = values[board[target_row][target_column].lower()]
-                if new_value > the_value:
-                    pins.append(new_value + the_value)
-                    break
-            target_row = target_row + 1
-            target_column = target_column - 1
-
-        # lower right
-        target_row = row + 1
-        target_column = column + 1
-        the_value = -100
-        while target_row <= 7 and target_column <= 7:
-            if board[target_row][target_column] in friendly_pieces:
-                break
-            if board[target_row][target_column] == '-':
-                target_row = target_row + 1
-                target_column = target_column + 1
-                continue
-            if the_value == -100:
-                the_value = values[board[target_row][target_column].lower()]
-            else:
-                new_value = values[board[target_row][target_column].lower()]
-                if new_value > the_value:
-                    pins.append(new_value + the_value)
-                    break
-            target_row = target_row + 1
-            target_column = target_column + 1
-        return pins
+        # Engines are shared with the search (a single lazily started one when used on its own)
+        self.engines = engines if engines is not None else EnginePool(size=1)
 
     def get_pinned_pieces(self, fen_position: str) -> list:
-        values = self.values
-        values['k'] = 15
-
-        white_pieces = 'RNBQKP'
-        black_pieces = 'rnbqkp'
-
-        player = fen_position.split()[1]
-        friendly_pieces = black_pieces if player == 'b' else white_pieces
-        board_array = MoveGenerator.board_numpy(fen_position)
+        """
+            Pin values (first + second enemy piece) of the rays of the side to move's sliders: rooks along
+            files and ranks, bishops along diagonals and queens along both. Only occupied ray squares are
+            visited, nearest first, a friendly piece blocks the ray
+        """
+        board = parse_board(fen_position)
+        turn = board.turn
+        own = board.occupied_co[turn]
 
         pinned_pieces = []
-        for row in range(8):
-            for column in range(8):
-                piece = board_array[row][column]
-                if piece in friendly_pieces:
-                    the_value = -100
-                    found = 0
-                    if piece.lower() in ['r', 'q']:
-                        straight_pins = self.check_straight_lines(board_array, row, column, friendly_pieces, values)
-                        if len(straight_pins) > 0:
-                            pinned_pieces.append(max(straight_pins))
-                        diagonal_pins = self.check_diagonal_lines(board_array, row, column, friendly_pieces, values)
-                        if len(diagonal_pins) > 0:
-                            pinned_pieces.append(max(diagonal_pins))
+        for piece_type, directions in PINNER_DIRECTIONS.items():
+            for square in chess.scan_forward(board.pieces_mask(piece_type, turn)):
+                for direction in directions:
+                    blockers = RAY_MASKS[square][direction] & board.occupied
+                    scan = chess.scan_forward if direction in ASCENDING_DIRECTIONS else chess.scan_reversed
+                    first = None
+                    for target in scan(blockers):
+                        if own & chess.BB_SQUARES[target]:
+                            break
+                        value = self.type_values[board.piece_type_at(target)]
+                        if first is None:
+                            first = value
+                        elif value > first:
+                            pinned_pieces.append(first + value)
+                            break
 
         return pinned_pieces
 
@@ -246,8 +207,7 @@ class Heuristics:
         return white_material, black_material
 
     def stockfish_evaluation(self, fen_position: str, *args) -> dict:
-        self.stockfish.set_fen_position(fen_position)
-        return self.stockfish.get_evaluation()
+        return self.engines.evaluation(fen_position, depth=10)
 
     def material_disadvantage(self, fen_position: str, *args) -> (bool, float):
         white, black = self.total_material(fen_position=fen_position)
@@ -273,47 +233,332 @@ class Heuristics:
         return pin_value > Heuristics.PIN_THRESHOLD, pin_value
 
     def fork(self, fen_position: str, *args) -> (bool, float):
-        moves = self.move_generator.get_capture_moves(fen_position)
-        board_numpy = MoveGenerator.board_numpy(fen_position)
-
-        fork_value = 0  # TODO: Calculate the pin value
-
-        captures = {}
-        for move in moves:
-            if move[:2] in captures:
-                captures[move[:2]].append(move[3:])
+        """
+            Pieces that attack two or more enemy pieces worth at least as much as themselves. Targets are the
+            attack set of the piece intersected with the enemy pieces (kings excluded), when the side to move
+            is in check only its legal captures count
+        """
+        board = parse_board(fen_position)
+        turn = board.turn
+        enemy = board.occupied_co[not turn] & ~board.kings
+
+        legal_targets = None
+        if board.is_check():
+            legal_targets = {}
+            for move in board.generate_legal_captures():
+                legal_targets[move.from_square] = legal_targets.get(move.from_square, 0) | chess.BB_SQUARES[move.to_square]
+
+        fork_value = 0
+        for square in chess.scan_forward(board.occupied_co[turn]):
+            if legal_targets is None:
+                targets = board.attacks_mask(square) & enemy
             else:
-                captures[move[:2]] = [move[3:]]
-
-        for key, value in captures.items():
-            row, col = self.get_piece_pos(key)
-            key = board_numpy[row][col]
-
-            if len(value) > 1:
-                forks = []
-                for captured_piece in value:
-                    row, col = self.get_piece_pos(captured_piece)
-                    piece = board_numpy[row][col]
-
-                    if self.values[piece.lower()] >= self.values[key.lower()]:
-                        forks.append(piece)
-                if len(forks) > 1:
-                    # run fork formula here
-                    fork_value += (1 / self.fork_constant) * (
-                                sum([self.values[piece.lower()] for piece in forks]) / self.values[key.lower()] + len(
-                            forks))
+                targets = legal_targets.get(square, 0) & enemy
+            if chess.popcount(targets) < 2:
+                continue
+
+            attacker_value = self.type_values[board.piece_type_at(square)]
+            forks = [value for value in (self.type_values[board.piece_type_at(target)]
+                                         for target in chess.scan_forward(targets)) if value >= attacker_value]
+            if len(forks) > 1:
+                fork_value += (1 / self.fork_constant) * (sum(forks) / attacker_value + len(forks))
 
         return fork_value > Heuristics.FORK_THRESHOLD, fork_value
 
-    def get_all_heuristics(self, fen_position_start: str, fen_position_end: str = None, num_moves=None) -> (
-    dict, float):
+    def get_all_heuristics(self, fen_position_start: str, fen_position_end: str = None, num_moves=None,
+                           threshold: float = None) -> (dict, float):
+        """
+            Flags and values of every heuristic and the total of the flagged ones, cheapest heuristic first.
+            With a threshold, None is returned as soon as the upper bounds of the remaining heuristics can not
+            lift the total above it, a returned result is always exact
+        """
+        bounds = None
+        if threshold is not None:
+            planes, white_to_move = Heuristics.encode_batch([fen_position_start])
+            bounds = {name: bound[0] for name, bound in self.upper_bounds(planes, white_to_move).items()}
+            if fen_position_end:
+                bounds["Sacrifice"] = np.inf
+
         result = {}
         total = 0
-        for name, func in self.heuristic_functions.items():
-            flag, val = func(fen_position_start, fen_position_end, num_moves)
+        remaining = self.registry.ordered()
+        while remaining:
+            if bounds is not None and total + sum(bounds[name] for name in remaining) <= threshold:
+                return None
+            name = remaining.pop(0)
+            _start = time.perf_counter()
+            flag, val = self.heuristic_functions[name](fen_position_start, fen_position_end, num_moves)
+            self.registry.record(name, time.perf_counter() - _start)
             if flag:
                 total += val
             result[name] = (flag, val)
         # result["stockfish"] = self.stockfish_evaluation(fen_position_start)
-        return result, total
+        return {name: result[name] for name in self.heuristic_functions}, total
+
+    def upper_bounds(self, planes: ndarray, white_to_move: ndarray) -> dict:
+        """
+            Largest contribution every heuristic can make to the total of each position (see encode_batch).
+            Material is exact, Sacrifice needs an end position and is 0. Pin and Fork look at the enemy pieces
+            a piece could reach on an empty board, blockers are ignored so the bounds never undercut them
+        """
+        count = len(planes)
+        own = np.where(white_to_move[:, None, None], planes[:, :6], planes[:, 6:])
+        enemy = np.where(white_to_move[:, None, None], planes[:, 6:], planes[:, :6])
+        values = np.array([self.values[piece] for piece in "pnbrqk"], dtype=np.float64)
+        attack_values = np.array([self.attack_values[piece] for piece in "pnbrqk"], dtype=np.float64)
+
+        white = np.round(planes[:, :6].sum(axis=2) @ values, 2)
+        black = np.round(planes[:, 6:].sum(axis=2) @ values, 2)
+        material = np.where(white * Heuristics.ADVANTAGE_THRESHOLD > black,
+                            np.abs((white - black) / self.material_disadvantage_constant), 0)
+
+        target_values = np.tensordot(attack_values, enemy, axes=(0, 1))
+        targets = enemy[:, :5].any(axis=1)
+        pin = np.zeros(count)
+        fork = np.zeros(count)
+        for piece_type in range(5):
+            positions, squares = np.nonzero(own[:, piece_type])
+            if not positions.size:
+                continue
+            if piece_type == 0:
+                reach = PAWN_ATTACKS[white_to_move[positions].astype(int), squares]
+            elif piece_type == 1:
+                reach = KNIGHT_ATTACKS[squares]
+            else:
+                reach = LINES[piece_type - 2][squares]
+
+            # A fork needs two reachable targets worth at least the attacker
+            attacker_value = attack_values[piece_type]
+            forked = reach & targets[positions] & (target_values[positions] >= attacker_value)
+            forked_count = forked.sum(axis=1)
+            forked_value = (target_values[positions] * forked).sum(axis=1)
+            np.add.at(fork, positions, np.where(forked_count > 1, forked_value / attacker_value + forked_count, 0))
+
+            if piece_type >= 2:
+                # A pin needs two enemy pieces on the lines of a slider, the first one is not the king
+                seen = reach & enemy[positions].any(axis=1)
+                first = (reach & targets[positions]) * target_values[positions]
+                second = seen * target_values[positions]
+                ray_pin = np.where(seen.sum(axis=1) > 1, first.max(axis=1) + second.max(axis=1), 0)
+                np.maximum.at(pin, positions, ray_pin)
+
+        return {
+            "Material": material,
+            "Sacrifice": np.zeros(count),
+            "Pin": pin / self.pin_constant,
+            "Fork": fork / self.fork_constant,
+        }
+
+    @staticmethod
+    def encode_batch(fen_positions: list) -> (ndarray, ndarray):
+        """ Returns the (N, 12, 64) piece planes of all positions and whether white is to move """
+        planes = np.zeros((len(fen_positions), 12, 64), dtype=bool)
+        white_to_move = np.zeros(len(fen_positions), dtype=bool)
+
+        for index, fen_position in enumerate(fen_positions):
+            board, turn = fen_position.split()[:2]
+            white_to_move[index] = turn == "w"
+            square = 56
+            for char in board:
+                if char == "/":
+                    square -= 16
+                elif char.isdigit():
+                    square += int(char)
+                else:
+                    planes[index, PLANE_INDEX[char], square] = True
+                    square += 1
+
+        return planes, white_to_move
+
+    def score_batch(self, fen_positions: list, breakdown: bool = False, threshold: float = None) -> ndarray:
+        """
+            Scores many positions at once, the result matches get_all_heuristics(fen)[1] for every FEN.
+            With breakdown=True the (N, 4) values of the heuristic_functions are returned instead,
+            flags follow from the same thresholds as the single-position functions.
+            Positions where the side to move is in check use fork(), which only counts legal captures.
+
+            Pin and Fork run cheapest first (see HeuristicRegistry). With a threshold, a heuristic skips the
+            positions whose total can not exceed it any more (see upper_bounds), those are left NaN
+        """
+        planes, white_to_move = Heuristics.encode_batch(fen_positions)
+        count = len(fen_positions)
+
+        values = np.array([self.values[piece] for piece in "pnbrqk"], dtype=np.float64)
+        attack_values = np.array([self.attack_values[piece] for piece in "pnbrqk"], dtype=np.float64)
+        columns = {name: column for column, name in enumerate(self.heuristic_functions)}
+        scores = np.zeros((count, len(columns)), dtype=np.float64)
+        flags = np.zeros((count, len(columns)), dtype=bool)
+
+        # Material (rounded like total_material)
+        _start = time.perf_counter()
+        white = np.round(planes[:, :6].sum(axis=2) @ values, 2)
+        black = np.round(planes[:, 6:].sum(axis=2) @ values, 2)
+        scores[:, columns["Material"]] = np.abs((white - black) / self.material_disadvantage_constant)
+        flags[:, columns["Material"]] = white * Heuristics.ADVANTAGE_THRESHOLD > black
+        self.registry.record("Material", time.perf_counter() - _start, count, batch=True)
+        # Sacrifice needs an end position, it is never set for single positions
+
+        # Flip the planes so that "own" is always the side to move
+        own = np.where(white_to_move[:, None, None], planes[:, :6], planes[:, 6:])
+        enemy = np.where(white_to_move[:, None, None], planes[:, 6:], planes[:, :6])
+
+        rows = np.arange(count)
+        if threshold is not None:
+            bounds = self.upper_bounds(planes, white_to_move)
+            total = scores[:, columns["Material"]] * flags[:, columns["Material"]]
+            remaining = bounds["Pin"] + bounds["Fork"]
+
+        for name in self.registry.ordered(["Pin", "Fork"], batch=True):
+            if threshold is not None:
+                rows = rows[total[rows] + remaining[rows] > threshold]
+                remaining -= bounds[name]
+
+            _start = time.perf_counter()
+            if name == "Pin":
+                value = self._pin_batch(own[rows], enemy[rows], attack_values) / self.pin_constant
+                flag = value > Heuristics.PIN_THRESHOLD
+            else:
+                value = self._fork_batch(own[rows], enemy[rows], white_to_move[rows], attack_values)
+                in_check = self._in_check_batch(own[rows], enemy[rows], white_to_move[rows])
+                for index in np.flatnonzero(in_check):
+                    value[index] = self.fork(fen_positions[rows[index]])[1]
+                flag = value > Heuristics.FORK_THRESHOLD
+            self.registry.record(name, time.perf_counter() - _start, len(rows), batch=True)
+
+            scores[rows, columns[name]] = value
+            flags[rows, columns[name]] = flag
+            if threshold is not None:
+                total[rows] += value * flag
+
+        if threshold is not None:
+            skipped = np.ones(count, dtype=bool)
+            skipped[rows] = False
+            scores[skipped] = np.nan
+
+        if breakdown:
+            return scores, flags
+        return (scores * flags).sum(axis=1)
+
+    @staticmethod
+    def _rays(occupancy: ndarray, positions: ndarray, squares: ndarray) -> ndarray:
+        """ (K, 8, 7) contents of the rays from the given squares, off-board squares read as padding """
+        padded = np.concatenate([occupancy, np.zeros((occupancy.shape[0], 1), dtype=occupancy.dtype)], axis=1)
+        return padded[positions[:, None, None], RAYS[squares]]
+
+    def _pin_batch(self, own: ndarray, enemy: ndarray, attack_values: ndarray) -> ndarray:
+        """ Highest pin found by a slider of the side to move, like get_pinned_pieces """
+        pins = np.zeros(own.shape[0], dtype=np.float64)
+        positions, squares = np.nonzero(own[:, 2] | own[:, 3] | own[:, 4])
+        if not positions.size:
+            return pins
+
+        # Rooks pin along the first four directions, bishops along the last four and queens along all
+        queens = own[positions, 4, squares]
+        directions = np.zeros((positions.size, 8), dtype=bool)
+        directions[:, :4] = own[positions, 3, squares][:, None] | queens[:, None]
+        directions[:, 4:] = own[positions, 2, squares][:, None] | queens[:, None]
+
+        friendly = self._rays(own.any(axis=1), positions, squares)
+        friendly[RAYS[squares] == 64] = True
+        enemy_values = self._rays(np.tensordot(attack_values, enemy, axes=(0, 1)), positions, squares)
+        is_enemy = self._rays(enemy.any(axis=1), positions, squares)
+
+        # Everything from the first friendly piece (or the board edge) on is blocked
+        open_ray = ~np.logical_or.accumulate(friendly, axis=2)
+        is_enemy &= open_ray
+
+        has_first = is_enemy.any(axis=2)
+        first = is_enemy.argmax(axis=2)
+        first_value = np.take_along_axis(enemy_values, first[..., None], axis=2)
+
+        steps = np.arange(7)
+        behind = is_enemy & (steps > first[..., None]) & (enemy_values > first_value)
+        has_pin = has_first & behind.any(axis=2)
+        second_value = np.take_along_axis(enemy_values, behind.argmax(axis=2)[..., None], axis=2)[..., 0]
+
+        ray_pins = np.where(has_pin & directions, first_value[..., 0] + second_value, 0)
+        np.maximum.at(pins, positions, ray_pins.max(axis=1))
+        return pins
+
+    def _fork_batch(self, own: ndarray, enemy: ndarray, white_to_move: ndarray, attack_values: ndarray) -> ndarray:
+        """ Fork values of the side to move from the attack tables, like fork() """
+        forks = np.zeros(own.shape[0], dtype=np.float64)
+        occupied = own.any(axis=1) | enemy.any(axis=1)
+        # The king can never be captured
+        targets = enemy[:, :5].any(axis=1)
+        target_values = np.tensordot(attack_values, enemy, axes=(0, 1))
+
+        # The king's value is never matched by a target, it can not fork
+        for piece_type in range(5):
+            positions, squares = np.nonzero(own[:, piece_type])
+            if not positions.size:
+                continue
+
+            if piece_type == 0:
+                attacked = PAWN_ATTACKS[white_to_move[positions].astype(int), squares]
+            elif piece_type == 1:
+                attacked = KNIGHT_ATTACKS[squares]
+            else:
+                directions = [slice(4, 8), slice(0, 4), slice(0, 8)][piece_type - 2]
+                rays = RAYS[squares][:, directions]
+                hit = self._rays(occupied, positions, squares)[:, directions]
+                first = hit.argmax(axis=2)
+                first_square = np.where(hit.any(axis=2), np.take_along_axis(rays, first[..., None], axis=2)[..., 0],
+                                        64)
+                attacked = np.zeros((positions.size, 65), dtype=bool)
+                attacked[np.arange(positions.size)[:, None], first_square] = True
+                attacked = attacked[:, :64]
+
+            attacker_value = attack_values[piece_type]
+            forked = attacked & targets[positions] & (target_values[positions] >= attacker_value)
+            forked_count = forked.sum(axis=1)
+            forked_value = (target_values[positions] * forked).sum(axis=1)
+
+            fork_value = np.where(forked_count > 1, (forked_value / attacker_value + forked_count), 0)
+            np.add.at(forks, positions, fork_value / self.fork_constant)
+        return forks
+
+    @staticmethod
+    def _in_check_batch(own: ndarray, enemy: ndarray, white_to_move: ndarray) -> ndarray:
+        """ Whether the king of the side to move is attacked """
+        in_check = np.zeros(own.shape[0], dtype=bool)
+        positions, squares = np.nonzero(own[:, 5])
+        if not positions.size:
+            return in_check
+
+        occupied = own.any(axis=1) | enemy.any(axis=1)
+        checked = (KNIGHT_ATTACKS[squares] & enemy[positions, 1]).any(axis=1)
+        checked |= (PAWN_ATTACKS[white_to_move[positions].astype(int), squares] & enemy[positions, 0]).any(axis=1)
+
+        hit = Heuristics._rays(occupied, positions, squares)
+        first = hit.argmax(axis=2)
+        first_square = np.take_along_axis(RAYS[squares], first[..., None], axis=2)[..., 0]
+        first_square = np.where(hit.any(axis=2), first_square, 64)
+        padded = np.concatenate([enemy, np.zeros(enemy.shape[:2] + (1,), dtype=bool)], axis=2)
+        straight = padded[positions[:, None], 3, first_square[:, :4]] | padded[positions[:, None], 4, first_square[:, :4]]
+        diagonal = padded[positions[:, None], 2, first_square[:, 4:]] | padded[positions[:, None], 4, first_square[:, 4:]]
+        checked |= straight.any(axis=1) | diagonal.any(axis=1)
+
+        in_check[positions] = checked
+        return in_check
+
+    def get_all_heuristics_batch(self, fen_positions: list, threshold: float = None) -> list:
+        """
+            get_all_heuristics for many start positions at once (see score_batch).
+            With a threshold, positions whose total can not exceed it get None
+        """
+        if not fen_positions:
+            return []
+        scores, flags = self.score_batch(fen_positions, breakdown=True, threshold=threshold)
+        names = list(self.heuristic_functions)
+
+        results = []
+        for position_scores, position_flags in zip(scores.tolist(), flags.tolist()):
+            if math.isnan(position_scores[0]):
+                results.append(None)
+                continue
+            result = {name: (flag, val) for name, flag, val in zip(names, position_flags, position_scores)}
+            total = sum(val for flag, val in zip(position_flags, position_scores) if flag)
+            results.append((result, total))
+        return results
 
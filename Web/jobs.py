@@ -0,0 +1,268 @@
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+
+from cache import normalize_fen
+from generator import GameState, SearchContext, puzzle_record
+from metrics import REGISTRY, SearchTrace
+from puzzle_index import PuzzleIndex
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class QueueFull(Exception):
+    """ Raised when no more jobs can be accepted (backpressure) """
+
+
+class JobCancelled(Exception):
+    """ Raised inside a running search to abort it """
+
+
+def search_key(context: SearchContext) -> tuple:
+    """ Searches with equal keys give the same puzzles: normalized FEN and all other search parameters """
+    return (normalize_fen(context.fen),) + tuple(context[1:])
+
+
+class SingleFlight:
+    """
+        Runs one computation per key at a time, callers that ask for a key already in flight wait for
+        that computation and get the same result (or exception).
+
+        Admission control: at most max_active computations run at once and up to max_waiting more wait
+        for a slot (at most timeout seconds), any further new key raises QueueFull. Duplicates of a key in
+        flight are always admitted, they cost nothing.
+    """
+
+    def __init__(self, max_active: int = 2, max_waiting: int = 8, timeout: float = 30) -> None:
+        self.max_active = max_active
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+
+        self._flights = {}
+        self._admitted = 0
+        self._slots = threading.BoundedSemaphore(max_active)
+        self._lock = threading.Lock()
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+    def do(self, key, function):
+        """ Returns function() for the key, computed once for all concurrent callers """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                if self._admitted >= self.max_active + self.max_waiting:
+                    REGISTRY.inc("single_flight_rejected_total", 1, "Searches rejected by admission control")
+                    raise QueueFull(f"{self._admitted} searches are already running or waiting")
+                flight = self._flights[key] = Future()
+                self._admitted += 1
+                leader = True
+            else:
+                leader = False
+
+        if not leader:
+            REGISTRY.inc("single_flight_coalesced_total", 1, "Requests that shared a search already in flight")
+            return flight.result()
+
+        try:
+            if not self._slots.acquire(timeout=self.timeout):
+                raise QueueFull(f"no search slot became free within {self.timeout} seconds")
+            try:
+                flight.set_result(function())
+            finally:
+                self._slots.release()
+        except BaseException as error:
+            flight.set_exception(error)
+        finally:
+            with self._lock:
+                del self._flights[key]
+                self._admitted -= 1
+        return flight.result()
+
+
+class Job:
+    def __init__(self, context: SearchContext, trace: bool = False) -> None:
+        self.id = uuid.uuid4().hex
+        self.context = context
+        # Per-depth timings and counters, only kept when asked for
+        self.trace = SearchTrace() if trace else None
+        self.status = QUEUED
+        self.error = None
+
+        # Puzzles found so far and number of puzzles per finished depth
+        self.puzzles = []
+        self.depths = {}
+
+        self.created = time.time()
+        self.finished = None
+
+        self.cancel_requested = threading.Event()
+        # Submissions that share this job, it is only cancelled once all of them cancelled it
+        self.submitters = 1
+        # Notified on every change, event streams wait on it
+        self.changed = threading.Condition()
+        self.version = 0
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in (DONE, FAILED, CANCELLED)
+
+    def update(self, **changes) -> None:
+        with self.changed:
+            for name, value in changes.items():
+                setattr(self, name, value)
+            if self.is_finished and self.finished is None:
+                self.finished = time.time()
+            self.version += 1
+            self.changed.notify_all()
+
+    def wait(self, version: int, timeout: float = None) -> int:
+        """ Blocks until the job changed after the given version, returns the current version """
+        with self.changed:
+            self.changed.wait_for(lambda: self.version != version or self.is_finished, timeout=timeout)
+            return self.version
+
+    def to_dict(self) -> dict:
+        result = {
+            "id": self.id,
+            "fen": self.context.fen,
+            "max_depth": self.context.max_depth,
+            "status": self.status,
+            "error": self.error,
+            "depths": self.depths,
+            "puzzles": self.puzzles,
+        }
+        if self.trace is not None:
+            result["trace"] = self.trace.to_dict()
+        return result
+
+
+class JobManager:
+    """
+        Runs puzzle searches in a local pool of worker threads.
+
+        Jobs wait in a bounded queue, submit raises QueueFull once it is full. All workers
+        search through the same GameState, finished jobs are forgotten after job_ttl seconds.
+        Submitting a search equal to a queued or running job returns that job instead of a new one,
+        the job is then only cancelled once every submission of it asked to.
+        With a puzzle index, indexed positions are answered from it and finished searches are added to it.
+    """
+
+    def __init__(self, game_state: GameState, workers: int = 1, max_queue: int = 16, job_ttl: float = 600,
+                 puzzle_index: PuzzleIndex = None) -> None:
+        self.game_state = game_state
+        self.puzzle_index = puzzle_index
+        self.job_ttl = job_ttl
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._jobs = {}
+        # (search_key, trace) -> job of every queued or running job
+        self._unfinished = {}
+        self._lock = threading.Lock()
+
+        self._workers = [threading.Thread(target=self._work, name=f"puzzle-worker-{i}", daemon=True)
+                         for i in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, fen: str, max_depth: int = 6, trace: bool = False) -> Job:
+        self._expire()
+        job = Job(SearchContext(fen, max_depth), trace=trace)
+        key = (search_key(job.context), trace)
+        with self._lock:
+            running = self._unfinished.get(key)
+            if running is not None and not running.cancel_requested.is_set():
+                REGISTRY.inc("jobs_coalesced_total", 1, "Job submissions answered with an equal unfinished job")
+                running.submitters += 1
+                return running
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                raise QueueFull(f"{self._queue.maxsize} jobs are already waiting")
+            self._jobs[job.id] = job
+            self._unfinished[key] = job
+        return job
+
+    def get(self, job_id: str) -> Job:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> Job:
+        """ Queued jobs are dropped when a worker picks them up, running ones stop after the current depth """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job and not job.is_finished and job.submitters:
+                job.submitters -= 1
+                if not job.submitters:
+                    job.cancel_requested.set()
+        return job
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def _expire(self) -> None:
+        now = time.time()
+        with self._lock:
+            for job_id in [job_id for job_id, job in self._jobs.items()
+                           if job.finished and now - job.finished > self.job_ttl]:
+                del self._jobs[job_id]
+
+    def _work(self) -> None:
+        while True:
+            job = self._queue.get()
+            try:
+                self._run(job)
+            finally:
+                with self._lock:
+                    key = (search_key(job.context), job.trace is not None)
+                    if self._unfinished.get(key) is job:
+                        del self._unfinished[key]
+                self._queue.task_done()
+
+    def _run(self, job: Job) -> None:
+        if job.cancel_requested.is_set():
+            job.update(status=CANCELLED)
+            return
+
+        context = job.context
+        records = self.puzzle_index.get(context.fen, context.max_depth) if self.puzzle_index is not None else None
+        if records is not None:
+            depths = {}
+            for record in records:
+                depths[str(record["depth"])] = depths.get(str(record["depth"]), 0) + 1
+            job.update(status=DONE, puzzles=records, depths=depths)
+            return
+
+        job.update(status=RUNNING)
+        # Number of result rows of each move type already published
+        reported = {}
+
+        def progress(depth, results):
+            puzzles = []
+            for move_type, rows in results.items():
+                for row_depth, row in rows[reported.get(move_type, 0):]:
+                    puzzles.append(puzzle_record(move_type, row_depth, row))
+                reported[move_type] = len(rows)
+            job.update(puzzles=job.puzzles + puzzles, depths=dict(job.depths, **{str(depth): len(puzzles)}))
+
+            if job.cancel_requested.is_set():
+                raise JobCancelled()
+
+        try:
+            self.game_state.get_puzzles(progress=progress, context=job.context, trace=job.trace)
+        except JobCancelled:
+            job.update(status=CANCELLED)
+        except Exception as error:
+            job.update(status=FAILED, error=str(error))
+        else:
+            if self.puzzle_index is not None:
+                self.puzzle_index.add(context.fen, context.max_depth, job.puzzles)
+            job.update(status=DONE)
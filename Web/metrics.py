@@ -0,0 +1,141 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the search duration histogram
+DURATION_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in sorted(labels.items())) + "}"
+
+
+class Registry:
+    """
+        Process-wide counters, histograms and gauges, rendered in the Prometheus text format.
+
+        Metrics are created on first use, gauges read their value from a callback at render time.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._help = {}
+        self._types = {}
+        # name -> {labels string: value}
+        self._counters = {}
+        # name -> {labels string: [bucket counts, sum, count]}
+        self._histograms = {}
+        self._buckets = {}
+        self._gauges = {}
+
+    def inc(self, name: str, value: float = 1, help: str = "", **labels) -> None:
+        key = _labels(labels)
+        with self._lock:
+            self._declare(name, "counter", help)
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, help: str = "", buckets: tuple = DURATION_BUCKETS, **labels) -> None:
+        key = _labels(labels)
+        with self._lock:
+            self._declare(name, "histogram", help)
+            self._buckets.setdefault(name, buckets)
+            series = self._histograms.setdefault(name, {})
+            counts, total, count = series.get(key) or ([0] * len(self._buckets[name]), 0, 0)
+            for index, bound in enumerate(self._buckets[name]):
+                if value <= bound:
+                    counts[index] += 1
+            series[key] = [counts, total + value, count + 1]
+
+    def gauge(self, name: str, callback, help: str = "") -> None:
+        """ Registers a gauge whose value is callback() """
+        with self._lock:
+            self._declare(name, "gauge", help)
+            self._gauges[name] = callback
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, kind in self._types.items():
+                if self._help[name]:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+                if kind == "counter":
+                    lines.extend(f"{name}{key} {value}" for key, value in self._counters[name].items())
+                elif kind == "gauge":
+                    lines.append(f"{name} {self._gauges[name]()}")
+                else:
+                    for key, (counts, total, count) in self._histograms[name].items():
+                        inner = key[1:-1] + "," if key else ""
+                        for bound, bucket in zip(self._buckets[name], counts):
+                            lines.append(f'{name}_bucket{{{inner}le="{bound}"}} {bucket}')
+                        lines.append(f'{name}_bucket{{{inner}le="+Inf"}} {count}')
+                        lines.append(f"{name}_sum{key} {total}")
+                        lines.append(f"{name}_count{key} {count}")
+        return "\n".join(lines) + "\n"
+
+    def _declare(self, name: str, kind: str, help: str) -> None:
+        if name not in self._types:
+            self._types[name] = kind
+            self._help[name] = help
+
+
+REGISTRY = Registry()
+
+
+class SearchTrace:
+    """
+        Timers and counters of one puzzle search, per depth.
+
+        Stages: generate (retro-moves), validate, structure, heuristics, engine, filter.
+        Counters: nodes_expanded, retro_moves, candidates, rejected_<filter stage>, engine_calls, tablebase_hits,
+        cache_hits, engine_skipped, engine_coalesced, best_moves, pruned_threshold, pruned_beam, pruned_frontier,
+        duplicates.
+        Every finished depth is added to the registry, to_dict() is the per-request trace.
+    """
+
+    def __init__(self, registry: Registry = REGISTRY) -> None:
+        self.registry = registry
+        self.started = time.time()
+        self.layers = []
+        self._layer = None
+
+    def start_layer(self, depth: int) -> None:
+        self._layer = {"depth": depth, "started": time.perf_counter(), "seconds": {}, "counts": {}}
+
+    def add_time(self, stage: str, seconds: float) -> None:
+        self._layer["seconds"][stage] = self._layer["seconds"].get(stage, 0) + seconds
+
+    def count(self, name: str, value: int = 1) -> None:
+        self._layer["counts"][name] = self._layer["counts"].get(name, 0) + value
+
+    @contextmanager
+    def stage(self, name: str):
+        _start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - _start)
+
+    def end_layer(self) -> None:
+        layer = self._layer
+        layer["total_seconds"] = time.perf_counter() - layer.pop("started")
+        self.layers.append(layer)
+        self._layer = None
+
+        for stage, seconds in layer["seconds"].items():
+            self.registry.inc("puzzle_stage_seconds_total", seconds, "Time spent per search stage", stage=stage)
+        for name, value in layer["counts"].items():
+            self.registry.inc("puzzle_search_events_total", value, "Search counters (nodes, engine calls, pruning)",
+                              event=name)
+        self.registry.inc("puzzle_depth_seconds_total", layer["total_seconds"], "Time spent per search depth",
+                          depth=layer["depth"])
+
+    def finish(self) -> None:
+        self.registry.inc("puzzle_searches_total", 1, "Finished puzzle searches")
+        self.registry.observe("puzzle_search_seconds", time.time() - self.started, "Duration of puzzle searches")
+
+    def to_dict(self) -> dict:
+        return {"seconds": time.time() - self.started, "layers": self.layers}
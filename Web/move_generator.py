@@ -1,329 +1,275 @@
 
+import struct
+import time
+from typing import NamedTuple
+
 import chess
-from numpy import ndarray
-import numpy as np
 
-stockfish_path = "stockfish_14.1_win_x64_avx2/stockfish_14.1_win_x64_avx2.exe"
 
+def flip_move(position):
+    arr = position.split()
+    arr[1] = "b" if arr[1] == "w" else "w"
+    return " ".join(arr)
 
-def square(file_index: int, rank_index: int):
-    """ Gets a square number by file and rank index """
-    return rank_index * 8 + file_index
 
+# Number of pieces of each type a side starts with, anything below can be un-captured
+INITIAL_PIECES = {
+    chess.PAWN: 8,
+    chess.KNIGHT: 2,
+    chess.BISHOP: 2,
+    chess.ROOK: 2,
+    chess.QUEEN: 1,
+}
 
-class ChessBoard(chess.Board):
-    def find_move(self, from_square, to_square, promotion=None):
-        """ Overridden to suppress move validation """
-        return self._from_chess960(self.chess960, from_square, to_square, promotion)
+PROMOTION_PIECES = [chess.KNIGHT, chess.BISHOP, chess.ROOK, chess.QUEEN]
 
+# Packed position key: pawns, knights, bishops, rooks, queens, kings, white, black, castling rights, turn
+KEY_FORMAT = struct.Struct("<9Q?")
 
-class LegalMoves(chess.LegalMoveGenerator):
-    """ Add a new method to existing class to get desired format of moves """
-    def to_array(self):
-        return [self.board.lan(move) for move in self]
 
+class RetroMove(NamedTuple):
+    """
+        A move that leads *into* the current position.
 
-def uci(move):
-    move = move.replace("+", "")
-    move = move.replace("#", "")
-    if "=" in move:
-       move = move[:move.index("=")]
-    return move[-5:].replace("-", "")
+        from_square/to_square/promotion describe the forward move played in the previous
+        position, captured is the piece type that stood on to_square before it (None for quiet moves).
+    """
+    move_type: str
+    from_square: int
+    to_square: int
+    promotion: int = None
+    captured: int = None
 
+    @property
+    def move(self) -> chess.Move:
+        return chess.Move(self.from_square, self.to_square, self.promotion)
 
-def inverse(move):
-    return move[2:] + move[:2]
+    def uci(self) -> str:
+        return self.move.uci()
 
 
-def flip_move(position):
-    arr = position.split()
-    arr[1] = "b" if arr[1] == "w" else "w"
-    return " ".join(arr)
+class RetroBoard(chess.Board):
+    """
+        Board that can be moved backwards in place: push_retro/pop_retro un-play and re-play a RetroMove.
+
+        The search keeps a single RetroBoard per layer and restores the frontier positions from
+        their key(), FEN strings are only made for the engine and the results.
+    """
+
+    def __init__(self, fen: str = chess.STARTING_FEN) -> None:
+        super().__init__(fen)
+        self._retro_stack = []
+
+    def key(self) -> bytes:
+        """ Compact immutable key of the position, see KEY_FORMAT (clocks and en passant are not part of it) """
+        return KEY_FORMAT.pack(self.pawns, self.knights, self.bishops, self.rooks, self.queens, self.kings,
+                               self.occupied_co[chess.WHITE], self.occupied_co[chess.BLACK],
+                               self.castling_rights, self.turn)
+
+    def set_key(self, key: bytes, halfmove_clock: int = 0, fullmove_number: int = 1) -> None:
+        """ Sets up the position of a key() """
+        (self.pawns, self.knights, self.bishops, self.rooks, self.queens, self.kings,
+         white, black, self.castling_rights, self.turn) = KEY_FORMAT.unpack(key)
+        self.occupied_co = [black, white]
+        self.occupied = white | black
+        self.promoted = chess.BB_EMPTY
+        self.ep_square = None
+        self.halfmove_clock = halfmove_clock
+        self.fullmove_number = fullmove_number
+        self.clear_stack()
+        self._retro_stack = []
+
+    def push_retro(self, retro: RetroMove) -> None:
+        """ Takes back the move, afterwards the player who made it is to move """
+        player = not self.turn
+        piece_type = self._remove_piece_at(retro.to_square)
+        self._retro_stack.append((retro, piece_type, self.castling_rights, self.ep_square,
+                                  self.halfmove_clock, self.fullmove_number))
+
+        self._set_piece_at(retro.from_square, chess.PAWN if retro.promotion else piece_type, player)
+        if retro.captured:
+            self._set_piece_at(retro.to_square, retro.captured, self.turn)
+
+        self.turn = player
+        self.ep_square = None
+        self.castling_rights = self.clean_castling_rights()
+        self.halfmove_clock = max(self.halfmove_clock - 1, 0)
+        if player == chess.BLACK:
+            self.fullmove_number = max(self.fullmove_number - 1, 1)
+
+    def pop_retro(self) -> RetroMove:
+        """ Plays the last taken back move again """
+        retro, piece_type, self.castling_rights, self.ep_square, self.halfmove_clock, self.fullmove_number = \
+            self._retro_stack.pop()
+        player = self.turn
+
+        self._remove_piece_at(retro.from_square)
+        if retro.captured:
+            self._remove_piece_at(retro.to_square)
+        self._set_piece_at(retro.to_square, piece_type, player)
+        self.turn = not player
+        return retro
 
 
 class MoveGenerator:
     """
-        Previous moves list:
-            1. All possible legal (non-pawn) moves at a given position (Breaks down if opponent is in check)
-            2. Pawn Moves (back + uncapture)
-            3. En Passant (MAYBE we can skip this)
-            4. All possible legal moves + uncapture the moves
+        Previous moves list (generated straight from the bitboards of a single chess.Board):
+            1. legal: All quiet un-moves of non-pawn pieces
+            2. pawn: Pawn retreats (one and two squares) + un-promotions
+            3. uncapture: Piece and pawn un-moves that leave a captured piece behind (+ capturing un-promotions)
+            4. En Passant (MAYBE we can skip this)
             5. Un-Castle (not a priority)
     """
 
-    def __init__(self) -> None:
-        # 64 8x8 square matrix
-        self.mapper = np.linspace(1, 64, num=64, dtype=int).reshape((8, 8))
-
-        # map fen to 8x8 matrix chess board
-        self.map_fen = {alpha: num for alpha, num in zip("abcdefgh", range(8))}
+    @staticmethod
+    def uncapture_pieces(board: chess.Board, color: bool, square: int) -> list:
+        """ Piece types of the given color that could have been captured on the square """
+        pieces = []
+        for piece_type, count in INITIAL_PIECES.items():
+            if chess.popcount(board.pieces_mask(piece_type, color)) >= count:
+                continue
+            if piece_type == chess.PAWN and chess.BB_SQUARES[square] & chess.BB_BACKRANKS:
+                continue
+            if piece_type == chess.BISHOP:
+                # A second bishop can only be un-captured on the other square colour
+                same_colour = chess.BB_LIGHT_SQUARES if chess.BB_SQUARES[square] & chess.BB_LIGHT_SQUARES \
+                    else chess.BB_DARK_SQUARES
+                if board.pieces_mask(chess.BISHOP, color) & same_colour:
+                    continue
+            pieces.append(piece_type)
+        return pieces
+
+    def retro_moves(self, board: chess.Board) -> list:
+        """
+            Returns all (pseudo-legal) retro-moves of the player who just moved in the given board.
+            Nothing is validated except for empty squares and piece counts, see is_valid_retro
+        """
+        player = not board.turn
+        opponent = board.turn
+        empty = ~board.occupied & chess.BB_ALL
+
+        retro = []
+
+        # Pieces move back along their own attack rays
+        last_rank = chess.BB_RANK_8 if player == chess.WHITE else chess.BB_RANK_1
+        for to_square in chess.scan_reversed(board.occupied_co[player] & ~board.pawns):
+            origins = board.attacks_mask(to_square) & empty
+            captured = self.uncapture_pieces(board, opponent, to_square) if origins else []
+            for from_square in chess.scan_reversed(origins):
+                retro.append(RetroMove("legal", from_square, to_square))
+                for piece in captured:
+                    retro.append(RetroMove("uncapture", from_square, to_square, captured=piece))
+
+            piece_type = board.piece_type_at(to_square)
+            if piece_type != chess.KING and chess.BB_SQUARES[to_square] & last_rank:
+                retro.extend(self._unpromotions(board, player, to_square, piece_type, empty))
+
+        # Pawns retreat straight back or diagonally (un-capture)
+        direction = 1 if player == chess.WHITE else -1
+        second_rank = 1 if player == chess.WHITE else 6
+        for to_square in chess.scan_reversed(board.pawns & board.occupied_co[player]):
+            rank = chess.square_rank(to_square)
+            if not 1 <= rank - direction <= 6:
+                continue
+
+            one_back = to_square - 8 * direction
+            if chess.BB_SQUARES[one_back] & empty:
+                retro.append(RetroMove("pawn", one_back, to_square))
+                two_back = one_back - 8 * direction
+                if rank - 2 * direction == second_rank and chess.BB_SQUARES[two_back] & empty:
+                    retro.append(RetroMove("pawn", two_back, to_square))
+
+            origins = chess.BB_PAWN_ATTACKS[opponent][to_square] & empty
+            if origins:
+                for piece in self.uncapture_pieces(board, opponent, to_square):
+                    for from_square in chess.scan_reversed(origins):
+                        retro.append(RetroMove("uncapture", from_square, to_square, captured=piece))
+
+        return retro
+
+    def _unpromotions(self, board, player, to_square, piece_type, empty) -> list:
+        """ A piece on the last rank may have been a pawn on the previous move """
+        retro = []
+        opponent = not player
+        behind = to_square - 8 if player == chess.WHITE else to_square + 8
+        if chess.BB_SQUARES[behind] & empty:
+            retro.append(RetroMove("pawn", behind, to_square, promotion=piece_type))
+
+        origins = chess.BB_PAWN_ATTACKS[opponent][to_square] & empty
+        if origins:
+            for piece in self.uncapture_pieces(board, opponent, to_square):
+                for from_square in chess.scan_reversed(origins):
+                    retro.append(RetroMove("uncapture", from_square, to_square, promotion=piece_type, captured=piece))
+        return retro
 
     @staticmethod
-    def board_numpy(board) -> ndarray:
-        """ Return 2d array for the board position """
-        board = board.split()[0].split("/")
-
-        arr = list()
-
-        for row in board:
-            res = ""
-            for val in row:
-                if val.isnumeric():
-                    res += int(val) * "-"
-                else:
-                    res += val
-            arr.append(list(res))
-
-        return np.array(arr)
-
-    def index_to_fen(self, index: int) -> str:
-        """ Convert 64-value index to board position """
-        x, y = 8 - ((index - 1) // 8), (index - 1) % 8
-        y = "abcdefgh"[y]
-
-        return y + str(x)
-
-    def get_legal_moves(self, fen_pos: str) -> list:
-        board = ChessBoard(fen_pos)
-        legal = LegalMoves(board).to_array()
-        return [uci(x) for x in legal if not x.islower() and "x" not in x]
-
-    def get_capture_moves(self, fen_pos: list) -> list:
-        # TODO: Replace with all moves
-        board = ChessBoard(fen_pos)
-        legal = LegalMoves(board).to_array()
-        moves = [uci(move) for move in legal if "x" in move]
-        return moves
+    def predecessor(board: chess.Board, retro: RetroMove) -> chess.Board:
+        """ The position before the retro-move was played (player who made the move is to move) """
+        previous = board.copy(stack=False)
+        player = not board.turn
+
+        piece = previous.remove_piece_at(retro.to_square)
+        if retro.promotion:
+            piece = chess.Piece(chess.PAWN, player)
+        previous.set_piece_at(retro.from_square, piece)
+        if retro.captured:
+            previous.set_piece_at(retro.to_square, chess.Piece(retro.captured, board.turn))
+
+        previous.turn = player
+        previous.ep_square = None
+        previous.castling_rights = previous.clean_castling_rights()
+        previous.halfmove_clock = max(board.halfmove_clock - 1, 0)
+        if player == chess.BLACK:
+            previous.fullmove_number = max(board.fullmove_number - 1, 1)
+        return previous
 
-    def get_pawn_moves(self, fen_pos: str) -> None:
+    @staticmethod
+    def is_valid_retro(board: chess.Board, retro: RetroMove) -> bool:
         """
-            Returns a tuple of (legal_moves, uncapture_moves) for all pawns of player in the given board
-            legal_moves: All non-capture moves from board (NOTE: does not validate for discover check)
-            uncapture_moves: Possible uncapture moves for all pawns (does not validate anything)
-                                -> Requires post-process for which piece to be uncaptured
+            Whether the board a retro-move was taken back to is a valid position in which its forward
+            move is legal. Only that single move is checked (pseudo-legality and king safety)
         """
-        player = fen_pos.split()[1]
-        fen_pos = MoveGenerator.board_numpy(fen_pos)
-
-        possible_moves, uncapture_moves = [], []
-
-        available_pieces = list(zip(*np.where(fen_pos == 'P'))) if player == "w" \
-            else list(zip(*np.where(fen_pos == 'p')))
-
-        updates = {
-            "w": {
-                "legal": lambda x: x < 6,
-                "double_move": lambda x: x == 4,
-                "update_one": 8,
-                "update_two": 16,
-                "capture_left": 7,
-                "capture_right": 9,
-            },
-
-            "b": {
-                "legal": lambda x: x > 1,
-                "double_move": lambda x: x == 3,
-                "update_one": -8,
-                "update_two": -16,
-                "capture_left": -9,
-                "capture_right": -7,
-            }
-        }
-
-        for piece in available_pieces:
-            if updates[player]["legal"](piece[0]):
-                mapper_number = self.mapper[piece[0]][piece[1]]
-                possible_moves.append((mapper_number, (mapper_number + updates[player]["update_one"])))
-                if updates[player]["double_move"](piece[0]):
-                    possible_moves.append((mapper_number, (mapper_number + updates[player]["update_two"])))
-                uncapture = [(mapper_number, mapper_number + updates[player]["capture_left"]),
-                             (mapper_number, mapper_number + updates[player]["capture_right"])]
-                uncapture_moves.extend(uncapture)
-
-        legal_pawn_moves = [
-            self.index_to_fen(initial) + self.index_to_fen(end)
-            for initial, end in possible_moves
-            if fen_pos[np.where(self.mapper == end)] == '-'
-        ]
-
-        moves_to_remove = []
-        # Illegal pawn uncaptures (when space is not empty)
-        for move in uncapture_moves:
-            row, column = np.where(self.mapper == move[1])
-            row, column = row[0], column[0]
-            if (fen_pos[row][column] != '-'):
-                moves_to_remove.append(move)
-
-        uncapture_moves = [i for i in uncapture_moves if i not in moves_to_remove]
-
-        uncapture_pawn_moves = [self.index_to_fen(initial) + self.index_to_fen(end) for initial, end in uncapture_moves]
-
-        for move in uncapture_pawn_moves:
-            move1 = int(move[1])
-            move3 = int(move[3])
-            if abs(move1 - move3) > 1 or abs(move1 - move3) == 0:
-                uncapture_pawn_moves.remove(move)
-        return {
-            "back": legal_pawn_moves,
-            "uncapture": uncapture_pawn_moves
-        }
-
-    # Get chess board position color - white/black
-    def get_position_color(self, mapper_number: int) -> str:
-        color_row = int(mapper_number / 8)
-        if color_row % 2 == 0:
-            if mapper_number % 2 == 0:
-                b_color = 0
-            elif mapper_number % 2 != 0:
-                b_color = 1
-
-        elif color_row % 2 != 0:
-            if mapper_number % 2 == 0:
-                b_color = 1
-            elif mapper_number % 2 != 0:
-                b_color = 0
-
-        if b_color == 0:
-            return "white"
-        else:
-            return "black"
-
-    def get_uncapture_moves(self, fen_pos: str, moves: list) -> list:
-        """ Return a list of FEN states that can be possible "uncapture" moves """
-
-        fen_numpy = MoveGenerator.board_numpy(fen_pos)
-        player = fen_pos.split()[1]
-        opponent = "w" if player == "b" else "b"
-
-        # All chess pieces
-        pieces = ['P'] * 8 + ['R'] + ['N'] + ['B'] + ['Q'] + ['K'] + ['B'] + ['N'] + ['R']
-
-        # Fetch pieces already on the board
-        if (opponent == 'b'):
-            pieces = [piece.lower() for piece in pieces]
-            pieces_on_board = [character for character in fen_pos.split()[0] if character.islower()]
-        else:
-            pieces_on_board = [character for character in fen_pos.split()[0] if character.isupper()]
-
-        # Pieces not on the board
-        for piece in pieces_on_board:
-            pieces.remove(piece)
-
-        # The same pieces will generate same uncapture states, so eliminate duplicates
-        uncapture_pieces = list(set(pieces))
-
-        previous_fens = []
-
-        # Outer loop for each move
-        for move in moves:
-
-            # Play the reverse chess move
-            board = ChessBoard(fen_pos)
-            board.push_san(move)
-
-            # For each piece for the current move
-            for piece in uncapture_pieces:
-
-                # Split fen into chess board rows
-                fen_arr = board.fen().split()
-                rows_list = fen_arr[0].split('/')
-
-                # Retrieve the row string and column to insert the uncapture piece
-                row = rows_list[8 - int(move[1])]
-                column_index = self.map_fen[move[0]]
-
-                # Convert the row string into list of characters for easy string manipulation
-                row = MoveGenerator.board_numpy(row)[0]
-
-                # Add the uncapture piece
-                row[column_index] = piece
-
-                # Update the fen
-                num_count = 0
-                string = ""
-                for char in row:
-                    if char == '-':
-                        num_count += 1
-                    else:
-                        string = string + (str(num_count) if num_count > 0 else "") + char
-                        num_count = 0
-                if num_count > 0:
-                    string = string + str(num_count)
-
-                rows_list[8 - int(move[1])] = string
-                new_fen = "/".join(rows_list)
-                fen_arr[0] = new_fen
-                new_fen = " ".join(fen_arr)
-
-                # Check if bishop is of different color
-                if piece == 'b' or piece == 'B':
-                    if piece in fen_pos:
-
-                        existing_X, existing_Y = np.where(MoveGenerator.board_numpy(fen_pos) == piece)
-                        existing_X, existing_Y = existing_X[0], existing_Y[0]
-                        existing_piece_position = self.mapper[existing_X][existing_Y]
-
-                        y = ord(move[0]) - 97
-                        x = 8 - int(move[1])
-                        mapper_number = self.mapper[x][y]
-
-                        # Get color of position for existing bishop
-                        existing_color = self.get_position_color(existing_piece_position)
-
-                        # Get color of position for uncaptured bishop
-                        color = self.get_position_color(mapper_number)
-                        if existing_color != color:
-                            previous_fens.append((move, new_fen))
+        return board.is_legal(retro.move) and board.is_valid()
 
-                else:
-                    previous_fens.append((move, new_fen))
-
-        return previous_fens
+    def children(self, board: RetroBoard, trace=None):
+        """
+            Takes back every valid retro-move of the board in turn and yields it while the board is in
+            the previous position, the board is restored when the generator moves on.
+            Generation and validation times go to the (SearchTrace) trace
+        """
+        _start = time.perf_counter()
+        retros = self.retro_moves(board)
+        if trace is not None:
+            trace.add_time("generate", time.perf_counter() - _start)
+            trace.count("retro_moves", len(retros))
+
+        for retro in retros:
+            board.push_retro(retro)
+            try:
+                _start = time.perf_counter()
+                valid = self.is_valid_retro(board, retro)
+                if trace is not None:
+                    trace.add_time("validate", time.perf_counter() - _start)
+                if valid:
+                    yield retro
+            finally:
+                board.pop_retro()
 
     def get_moves(self, fen_pos: str):
-        fen_pos = fen_pos.split()
-        fen_pos[1] = "w" if fen_pos[1] == "b" else "b"
-        fen_pos = " ".join(fen_pos)
-        player = fen_pos.split()[1]
-        board = ChessBoard(fen_pos)
-
-        legal = self.get_legal_moves(fen_pos)
-
-        pawns = self.get_pawn_moves(fen_pos)
-        uncapture_fens = self.get_uncapture_moves(board.fen(), legal) + self.get_uncapture_moves(board.fen(),
-                                                                                                 pawns["uncapture"])
-
-        pawns_back = pawns["back"]
-        legal_fens = []
-        pawns_back_fen = []
-
-        for move in legal:
-            board = ChessBoard(fen_pos)
-            board.push_san(move)
-
-            legal_fens.append((move, board.fen()))
-
-        for move in pawns_back:
-            board = ChessBoard(fen_pos)
-            board.push_san(move)
-            pawns_back_fen.append((move, board.fen()))
-
-        return {"legal": legal_fens, "pawn": pawns_back_fen, "uncapture": uncapture_fens}
+        """ Retro-moves of the player who just moved, as (forward move, previous board) by move type """
+        board = chess.Board(fen_pos)
+        moves = {"legal": [], "pawn": [], "uncapture": []}
+        for retro in self.retro_moves(board):
+            moves[retro.move_type].append((retro.uci(), MoveGenerator.predecessor(board, retro)))
+        return moves
 
     def get_all_moves(self, position):
+        """
+            Returns the validated retro-moves of the position as (forward move, FEN of the previous position)
+            NOTE: the side to move of the returned FEN is the one of the given position
+        """
         validated_states = {"legal": [], "pawn": [], "uncapture": []}
-        for move_type, moves in self.get_moves(position).items():
-            for move, fens in moves:
-                move = move[2:] + move[:2]
-
-                fen = fens.split()
-                fen[1] = "b" if fen[1] == "w" else "w"
-                fen = " ".join(fen)
-                board = chess.Board(fen)
-                if board.is_valid():
-                    legal = [uci(x).replace("x", "") for x in LegalMoves(board).to_array()]
-                    if move in legal:
-                        validated_states[move_type].append((move, fens))
+        board = RetroBoard(position)
+        for retro in self.children(board):
+            validated_states[retro.move_type].append((retro.uci(), flip_move(board.fen())))
         return validated_states
-
-
@@ -0,0 +1,83 @@
+import chess
+import numpy as np
+
+from move_generator import KEY_FORMAT, RetroBoard
+
+
+def encode_move(move: chess.Move) -> int:
+    """ Packs a move into 15 bits: from square, to square and promotion piece type """
+    return move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+
+
+def decode_move(code: int) -> chess.Move:
+    return chess.Move(code & 63, code >> 6 & 63, code >> 12 or None)
+
+
+class NodeStore:
+    """
+        Struct-of-arrays store of the nodes of one retro-search.
+
+        A node is a row index. Every row holds the packed position key (see KEY_FORMAT), the
+        move clocks, the index of the parent node (-1 for the root), the forward move that
+        leads from the node's position to its parent's and a float32 score. Arrays grow by
+        doubling, a node costs about 100 bytes.
+    """
+
+    def __init__(self, capacity: int = 1024) -> None:
+        self.size = 0
+        self.keys = np.zeros(capacity, dtype=f"V{KEY_FORMAT.size}")
+        self.clocks = np.zeros((capacity, 2), dtype=np.uint16)
+        self.parents = np.full(capacity, -1, dtype=np.int32)
+        self.moves = np.zeros(capacity, dtype=np.uint16)
+        self.depths = np.zeros(capacity, dtype=np.uint8)
+        self.scores = np.zeros(capacity, dtype=np.float32)
+
+    def __len__(self) -> int:
+        return self.size
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array[:self.size].nbytes for array in
+                   (self.keys, self.clocks, self.parents, self.moves, self.depths, self.scores))
+
+    def add(self, board: RetroBoard, parent: int = -1, move: chess.Move = None) -> int:
+        """ Stores the current position of the board, returns its node index """
+        if self.size == len(self.parents):
+            self._grow()
+        index = self.size
+        self.size += 1
+
+        self.keys[index] = np.void(board.key())
+        self.clocks[index] = board.halfmove_clock, board.fullmove_number
+        self.parents[index] = parent
+        if parent >= 0:
+            self.moves[index] = encode_move(move)
+            self.depths[index] = self.depths[parent] + 1
+        return index
+
+    def key(self, index: int) -> bytes:
+        return self.keys[index].tobytes()
+
+    def restore(self, index: int, board: RetroBoard) -> RetroBoard:
+        """ Sets the board up in the position of the node """
+        halfmove_clock, fullmove_number = self.clocks[index]
+        board.set_key(self.key(index), int(halfmove_clock), int(fullmove_number))
+        return board
+
+    def line(self, index: int) -> list:
+        """ Forward moves (UCI) that lead from the position of the node back to the root """
+        moves = []
+        while self.parents[index] >= 0:
+            moves.append(decode_move(int(self.moves[index])).uci())
+            index = self.parents[index]
+        return moves
+
+    def _grow(self) -> None:
+        capacity = 2 * len(self.parents)
+        for name in ("keys", "clocks", "parents", "moves", "depths", "scores"):
+            array = getattr(self, name)
+            grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+            if name == "parents":
+                grown.fill(-1)
+            grown[:len(array)] = array
+            setattr(self, name, grown)
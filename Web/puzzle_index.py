@@ -0,0 +1,449 @@
+"""
+    Precomputed puzzles of start positions, served from a memory-mapped file.
+
+        python puzzle_index.py build puzzles.jsonl --output puzzles.idx --max-depth 6
+        python puzzle_index.py merge puzzles.idx
+
+    build reads the JSONL output of batch.py. New results of the web app go into the append-only
+    delta segment next to the index (<path>.delta), merge folds it into a new main file.
+"""
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+import chess
+
+from move_generator import KEY_FORMAT, RetroBoard
+from node_store import decode_move, encode_move
+
+try:
+    import fcntl
+except ImportError:
+    # No advisory locks (Windows), a merge must not run while the app appends
+    fcntl = None
+
+MAGIC = b"PZIX"
+VERSION = 1
+HEADER_FORMAT = struct.Struct("<4sHI")
+# Position key (see KEY_FORMAT) and max_depth of the search
+ENTRY_KEY_FORMAT = struct.Struct(f"<{KEY_FORMAT.size}sB")
+# Entry key, offset and length of the entry's puzzles
+ENTRY_FORMAT = struct.Struct(f"<{KEY_FORMAT.size}sBQI")
+# Entry key and length of the puzzles that follow it in the delta segment
+FRAME_FORMAT = struct.Struct(f"<{KEY_FORMAT.size}sBI")
+COUNT_FORMAT = struct.Struct("<H")
+# Puzzle position key, move clocks, move type, depth, eval (cp, +-inf for mate), score,
+# flags of the heuristics and line length. The heuristic values and the line moves follow
+PUZZLE_FORMAT = struct.Struct(f"<{KEY_FORMAT.size}sHHBBffBB")
+
+MOVE_TYPES = ("legal", "pawn", "uncapture")
+HEURISTICS = ("Material", "Sacrifice", "Pin", "Fork")
+
+
+def position_key(fen_position: str) -> bytes:
+    """ Packed key of a FEN, positions that only differ by move clocks (or en passant) share it """
+    return RetroBoard(fen_position).key()
+
+
+def encode_puzzles(records: list) -> bytes:
+    """ Packs puzzle records (see puzzle_record), scores are stored as float32 """
+    chunks = [COUNT_FORMAT.pack(len(records))]
+    for record in records:
+        board = RetroBoard(record["fen"])
+        if record["mate"]:
+            evaluation = float("inf") if record["mate"] > 0 else float("-inf")
+        else:
+            evaluation = record["centipawn"] or 0
+        flags = sum(1 << HEURISTICS.index(name) for name in record["heuristics"])
+        line = [encode_move(chess.Move.from_uci(move)) for move in record["line"]]
+
+        chunks.append(PUZZLE_FORMAT.pack(board.key(), board.halfmove_clock, board.fullmove_number,
+                                         MOVE_TYPES.index(record["type"]), record["depth"], evaluation,
+                                         record["score"], flags, len(line)))
+        chunks.append(struct.pack(f"<{len(HEURISTICS)}f", *(record["heuristics"].get(name, 0)
+                                                               for name in HEURISTICS)))
+        chunks.append(struct.pack(f"<{len(line)}H", *line))
+    return b"".join(chunks)
+
+
+def decode_puzzles(data) -> list:
+    """ Puzzle records of encode_puzzles (values rounded to the float32 precision) """
+    board = RetroBoard()
+    (count,) = COUNT_FORMAT.unpack_from(data, 0)
+    offset = COUNT_FORMAT.size
+    records = []
+    for _ in range(count):
+        key, halfmove, fullmove, move_type, depth, evaluation, score, flags, length = \
+            PUZZLE_FORMAT.unpack_from(data, offset)
+        offset += PUZZLE_FORMAT.size
+        values = struct.unpack_from(f"<{len(HEURISTICS)}f", data, offset)
+        offset += 4 * len(HEURISTICS)
+        line = [decode_move(code).uci() for code in struct.unpack_from(f"<{length}H", data, offset)]
+        offset += 2 * length
+
+        board.set_key(bytes(key), halfmove, fullmove)
+        mate = None
+        if abs(evaluation) == float("inf"):
+            mate, evaluation = (1 if evaluation > 0 else -1), None
+        records.append({
+            "type": MOVE_TYPES[move_type],
+            "depth": depth,
+            "fen": board.fen(),
+            "move": line[0] if line else None,
+            "line": line,
+            "centipawn": int(evaluation) if evaluation is not None else None,
+            "mate": mate,
+            "heuristics": {name: round(value, 6) for index, (name, value) in enumerate(zip(HEURISTICS, values))
+                           if flags & 1 << index},
+            "score": round(score, 6),
+        })
+    return records
+
+
+def _header() -> bytes:
+    meta = json.dumps({"move_types": MOVE_TYPES, "heuristics": HEURISTICS}).encode()
+    return HEADER_FORMAT.pack(MAGIC, VERSION, len(meta)) + meta
+
+
+def _read_header(data, path: str) -> int:
+    """ Checks the header, returns the offset after it """
+    magic, version, length = HEADER_FORMAT.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} is not a puzzle index (version {VERSION})")
+    meta = json.loads(bytes(data[HEADER_FORMAT.size:HEADER_FORMAT.size + length]))
+    if tuple(meta["move_types"]) != MOVE_TYPES or tuple(meta["heuristics"]) != HEURISTICS:
+        raise ValueError(f"{path} was built with other move types or heuristics")
+    return HEADER_FORMAT.size + length
+
+
+def write_index(path: str, entries: dict) -> None:
+    """ Writes a main file from {(position key, max_depth): encoded puzzles}, atomically """
+    keys = sorted(entries)
+    _write_entries(path + ".tmp", len(keys), lambda: ((key, entries[key], 0, len(entries[key])) for key in keys))
+    os.replace(path + ".tmp", path)
+
+
+def _write_entries(path: str, count: int, entries) -> None:
+    """
+        Writes a main file from entries(), which iterates the count entries as ((position key, max_depth),
+        buffer, offset, length) sorted by key. It is called twice, for the table and for the puzzles,
+        so the puzzles are copied from their buffers without holding all of them in memory
+    """
+    header = _header()
+    offset = len(header) + 4 + count * ENTRY_FORMAT.size
+    with open(path, "wb") as file:
+        file.write(header)
+        file.write(struct.pack("<I", count))
+        for (key, max_depth), _, _, length in entries():
+            file.write(ENTRY_FORMAT.pack(key, max_depth, offset, length))
+            offset += length
+        for _, buffer, start, length in entries():
+            file.write(buffer[start:start + length])
+
+
+def _find_entry(data, table: int, count: int, target: tuple) -> int:
+    """ Index of the (position key, max_depth) entry in a main file table, None when it has none """
+    low, high = 0, count
+    while low < high:
+        middle = (low + high) // 2
+        entry = ENTRY_KEY_FORMAT.unpack_from(data, table + middle * ENTRY_FORMAT.size)
+        if entry < target:
+            low = middle + 1
+        elif entry > target:
+            high = middle
+        else:
+            return middle
+    return None
+
+
+def _merged(main, table: int, count: int, delta, delta_entries: list):
+    """ Entries of a main file and sorted delta entries in key order (see _write_entries), delta ones win """
+    index = 0
+    for entry, (offset, length) in delta_entries:
+        while index < count:
+            key, max_depth, main_offset, main_length = ENTRY_FORMAT.unpack_from(main, table + index *
+                                                                                ENTRY_FORMAT.size)
+            if (key, max_depth) > entry:
+                break
+            index += 1
+            if (key, max_depth) < entry:
+                yield (key, max_depth), main, main_offset, main_length
+        yield entry, delta, offset, length
+    for index in range(index, count):
+        key, max_depth, offset, length = ENTRY_FORMAT.unpack_from(main, table + index * ENTRY_FORMAT.size)
+        yield (key, max_depth), main, offset, length
+
+
+class PuzzleIndex:
+    """
+        Read-only sorted index of precomputed puzzles plus an append-only delta segment.
+
+        The main file holds fixed-size entries (position key, max_depth, offset, length) sorted by
+        key, followed by the packed puzzles. It is memory-mapped, so worker processes share it
+        through the page cache, and looked up by binary search. Results of new searches are
+        appended to the delta segment (<path>.delta), which every process re-reads incrementally.
+        merge() streams the main file and the delta into a new main file, other processes reopen it.
+        add() starts it in a background thread once the delta holds max_delta entries, failures of these
+        merges are counted in merge_failures (the last one in merge_error) and retried max_delta entries later.
+    """
+
+    # Seconds between checks for a new main file or delta entries of other processes
+    REFRESH_SECONDS = 1.0
+
+    def __init__(self, path: str, max_delta: int = 1000) -> None:
+        self.path = path
+        self.delta_path = path + ".delta"
+        # add() merges in the background once the delta holds this many entries (None: only merge explicitly)
+        self.max_delta = max_delta
+        self.merge_failures = 0
+        self.merge_error = None
+        self._merging = False
+        # Delta size at which add() starts the next background merge
+        self._merge_at = max_delta
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._map = None
+        self._file = None
+        self._main_stat = None
+        self._entries = 0
+        self._table = 0
+        # (position key, max_depth) -> (offset, length) of the delta segment
+        self._delta = {}
+        self._delta_size = 0
+        self._checked = 0
+
+        if not os.path.exists(self.delta_path):
+            with open(self.delta_path, "ab") as file:
+                if not file.tell():
+                    file.write(_header())
+        self._delta_file = open(self.delta_path, "a+b")
+        self._open_main()
+        self._read_delta()
+
+    def __len__(self) -> int:
+        return self._entries + len(self._delta)
+
+    def get(self, fen_position: str, max_depth: int) -> list:
+        """ Puzzle records of a start position, None when it is not indexed """
+        key = position_key(fen_position)
+        with self._lock:
+            if time.monotonic() - self._checked > self.REFRESH_SECONDS:
+                self._refresh()
+            data = self._find_delta(key, max_depth)
+            if data is None:
+                data = self._find_main(key, max_depth)
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return decode_puzzles(data)
+
+    def add(self, fen_position: str, max_depth: int, records: list) -> None:
+        """ Appends the puzzles of a start position to the delta segment """
+        key = position_key(fen_position)
+        data = encode_puzzles(records)
+        frame = FRAME_FORMAT.pack(key, max_depth, len(data)) + data
+        with self._lock:
+            self._locked(fcntl.LOCK_SH if fcntl else None)
+            try:
+                # Another process may have merged and emptied the delta since the last look at it
+                self._refresh()
+                # One write of the whole frame, appends of other processes can not interleave
+                os.write(self._delta_file.fileno(), frame)
+                self._read_delta()
+            finally:
+                self._locked(fcntl.LOCK_UN if fcntl else None)
+            merge = self.max_delta is not None and len(self._delta) >= self._merge_at and not self._merging
+            if merge:
+                self._merging = True
+        if merge:
+            threading.Thread(target=self._merge_in_background, name="puzzle-index-merge", daemon=True).start()
+
+    def merge(self) -> None:
+        """
+            Writes a new main file with the delta entries folded in and empties the delta. Lookups and
+            appends go on while the new file is written, entries appended meanwhile stay in the delta
+        """
+        with self._lock:
+            self._refresh()
+            main_stat, delta_size = self._main_stat, self._delta_size
+            delta_entries = sorted(self._delta.items())
+            main_file = open(self.path, "rb") if main_stat else None
+        if not delta_entries:
+            if main_file:
+                main_file.close()
+            return
+
+        main = mmap.mmap(main_file.fileno(), 0, access=mmap.ACCESS_READ) if main_file else None
+        delta = mmap.mmap(self._delta_file.fileno(), delta_size, access=mmap.ACCESS_READ)
+        try:
+            if main is not None and (os.fstat(main_file.fileno()).st_ino,
+                                     os.fstat(main_file.fileno()).st_mtime_ns) != main_stat:
+                # Merged by another process since the snapshot
+                return
+            table, count = 0, 0
+            if main is not None:
+                table = _read_header(main, self.path) + 4
+                (count,) = struct.unpack_from("<I", main, table - 4)
+            replaced = sum(_find_entry(main, table, count, entry) is not None for entry, _ in delta_entries)
+            _write_entries(self.path + ".tmp", count + len(delta_entries) - replaced,
+                           lambda: _merged(main, table, count, delta, delta_entries))
+        finally:
+            delta.close()
+            if main is not None:
+                main.close()
+                main_file.close()
+
+        with self._lock:
+            self._locked(fcntl.LOCK_EX if fcntl else None)
+            try:
+                stat = os.stat(self.path) if os.path.exists(self.path) else None
+                if (stat and (stat.st_ino, stat.st_mtime_ns)) != main_stat:
+                    os.remove(self.path + ".tmp")
+                    return
+                # Frames appended since the snapshot are kept for the new delta
+                self._delta_file.seek(delta_size)
+                tail = self._delta_file.read()
+                os.replace(self.path + ".tmp", self.path)
+                self._delta_file.truncate(0)
+                os.write(self._delta_file.fileno(), _header() + tail)
+                self._delta, self._delta_size = {}, 0
+                self._open_main()
+                self._read_delta()
+            finally:
+                self._locked(fcntl.LOCK_UN if fcntl else None)
+
+    def close(self) -> None:
+        with self._lock:
+            self._close_main()
+            self._delta_file.close()
+
+    def _merge_in_background(self) -> None:
+        try:
+            self.merge()
+        except Exception as error:
+            with self._lock:
+                self.merge_failures += 1
+                self.merge_error = f"{type(error).__name__}: {error}"
+                self._merge_at = len(self._delta) + self.max_delta
+            print(f"Puzzle index merge failed: {self.merge_error}", file=sys.stderr)
+        else:
+            self._merge_at = self.max_delta
+        finally:
+            self._merging = False
+
+    def _locked(self, operation) -> None:
+        if operation is not None:
+            fcntl.flock(self._delta_file.fileno(), operation)
+
+    def _find_main(self, key: bytes, max_depth: int):
+        index = _find_entry(self._map, self._table, self._entries, (key, max_depth))
+        if index is None:
+            return None
+        _, _, offset, length = ENTRY_FORMAT.unpack_from(self._map, self._table + index * ENTRY_FORMAT.size)
+        return self._map[offset:offset + length]
+
+    def _find_delta(self, key: bytes, max_depth: int):
+        found = self._delta.get((key, max_depth))
+        if found is None:
+            return None
+        return self._read(*found)
+
+    def _read(self, offset: int, length: int) -> bytes:
+        """ Bytes of the delta segment, appends always go to its end whatever the position """
+        self._delta_file.seek(offset)
+        return self._delta_file.read(length)
+
+    def _refresh(self) -> None:
+        self._checked = time.monotonic()
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            stat = None
+        if (stat and (stat.st_ino, stat.st_mtime_ns)) != self._main_stat:
+            # Merged by another process, its delta was emptied as well
+            self._open_main()
+            self._delta, self._delta_size = {}, 0
+        self._read_delta()
+
+    def _read_delta(self) -> None:
+        """ Indexes the delta frames appended since the last call (all of them after a merge elsewhere) """
+        size = os.fstat(self._delta_file.fileno()).st_size
+        if size < self._delta_size:
+            self._delta, self._delta_size = {}, 0
+        if size == self._delta_size:
+            return
+        data = self._read(self._delta_size, size - self._delta_size)
+        offset = 0
+        if not self._delta_size:
+            offset = _read_header(data, self.delta_path)
+        while offset + FRAME_FORMAT.size <= len(data):
+            key, max_depth, length = FRAME_FORMAT.unpack_from(data, offset)
+            if offset + FRAME_FORMAT.size + length > len(data):
+                # Frame still being written
+                break
+            self._delta[key, max_depth] = (self._delta_size + offset + FRAME_FORMAT.size, length)
+            offset += FRAME_FORMAT.size + length
+        self._delta_size += offset
+
+    def _open_main(self) -> None:
+        self._close_main()
+        if not os.path.exists(self.path):
+            self._main_stat = None
+            return
+        self._file = open(self.path, "rb")
+        stat = os.fstat(self._file.fileno())
+        self._main_stat = (stat.st_ino, stat.st_mtime_ns)
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        offset = _read_header(self._map, self.path)
+        (self._entries,) = struct.unpack_from("<I", self._map, offset)
+        self._table = offset + 4
+
+    def _close_main(self) -> None:
+        if self._map is not None:
+            self._map.close()
+            self._file.close()
+        self._map, self._file, self._entries = None, None, 0
+
+
+def build(args) -> None:
+    entries = {}
+    with open(args.input) as file:
+        for line in file:
+            record = json.loads(line)
+            if record.get("error"):
+                continue
+            entries[position_key(record["fen"]), args.max_depth] = encode_puzzles(record["puzzles"])
+    write_index(args.output, entries)
+    print(f"{len(entries)} positions written to {args.output}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    build_parser = commands.add_parser("build", help="build an index from the JSONL output of batch.py")
+    build_parser.add_argument("input")
+    build_parser.add_argument("--output", required=True)
+    build_parser.add_argument("--max-depth", type=int, default=6, help="max_depth the batch was run with")
+    merge_parser = commands.add_parser("merge", help="fold the delta segment into the main file")
+    merge_parser.add_argument("index")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build(args)
+    else:
+        index = PuzzleIndex(args.index, max_delta=None)
+        index.merge()
+        print(f"{len(index)} positions in {args.index}")
+        index.close()
+
+
+if __name__ == '__main__':
+    main()
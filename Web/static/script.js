@@ -1,21 +1,45 @@
+function puzzleLinks(puzzles) {
+    const links = puzzles.map(function (puzzle, i) {
+        const link = puzzle.fen.replaceAll(" ", "_");
+        return `<li><a href='https://lichess.org/analysis/${link}' target='_blank'>Puzzle ${i + 1}</a></li>`;
+    });
+    return "<ul>" + links.join("") + "</ul>";
+}
+
 $("#submit-btn").click(function (){
     const res = $("#results");
-    const fen_input = $("#fen").val();
-
-    const fen = fen_input.replaceAll("/", "^");
+    const fen = $("#fen").val();
 
     if (fen === "") {
         res.html("Invalid FEN");
         return;
     }
-    res.html("Retrieving puzzles, please wait. This may take up to 15 seconds");
+    res.html("Retrieving puzzles, please wait.");
 
     $.ajax({
-        url: "/get-fens-" + fen,
-        type: "GET",
+        url: "/jobs",
+        type: "POST",
         contentType: 'application/json',
-        success: function (data) {
-            res.html(data);
+        data: JSON.stringify({fen: fen}),
+        success: function (job) {
+            // Puzzles are shown as soon as a depth is finished
+            const events = new EventSource("/jobs/" + job.id + "/events");
+            events.onmessage = function (event) {
+                const state = JSON.parse(event.data);
+                let status = "";
+                if (state.status === "queued" || state.status === "running") {
+                    status = "<p>Searching, finished depths: " + Object.keys(state.depths).length + "</p>";
+                } else if (state.status === "failed") {
+                    status = "<p>Search failed: " + state.error + "</p>";
+                }
+                res.html(status + puzzleLinks(state.puzzles));
+                if (state.status !== "queued" && state.status !== "running") {
+                    events.close();
+                }
+            };
+        },
+        error: function (xhr) {
+            res.html(xhr.status === 503 ? "Too many searches running, please try again shortly" : "Invalid FEN");
         }
     });
 })
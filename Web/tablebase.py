@@ -0,0 +1,75 @@
+import threading
+
+import chess
+import chess.syzygy
+
+
+class Tablebase:
+    """
+        Syzygy tablebases of a local directory, used instead of the engine for positions with few pieces.
+
+        verdict() answers like the engine: {"Move", "Centipawn", "Mate"} from the side to move's
+        point of view, None when there is no legal move. Won and lost positions get Mate, its sign
+        is exact and its value is the distance to zeroing (DTZ) in moves, which is the distance to
+        mate when no capture or pawn move is left. Draws, cursed wins and blessed losses get 0 cp.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.tables = chess.syzygy.open_tablebase(path)
+        # Largest number of pieces (kings included) of a loaded WDL table
+        self.max_pieces = max((len(name) - 1 for name in self.tables.wdl), default=0)
+        self.hits = 0
+        self._lock = threading.Lock()
+
+    def covers(self, board: chess.Board) -> bool:
+        return not board.castling_rights and chess.popcount(board.occupied) <= self.max_pieces
+
+    def verdict(self, fen_position: str):
+        """ Returns (found, verdict), found is False when the tables do not have the position """
+        placement = fen_position.split(" ", 1)[0]
+        if sum(char.isalpha() for char in placement) > self.max_pieces:
+            return False, None
+        board = chess.Board(fen_position)
+        if not self.covers(board):
+            return False, None
+        try:
+            verdict = self._probe(board)
+        except KeyError:
+            # A table of the position or of one of its children is missing
+            return False, None
+        with self._lock:
+            self.hits += 1
+        return True, verdict
+
+    def _probe(self, board: chess.Board):
+        best, best_key = None, None
+        for move in board.legal_moves:
+            zeroing = board.is_zeroing(move)
+            board.push(move)
+            try:
+                if board.is_checkmate():
+                    key = (2, 1, 0, 0)
+                else:
+                    wdl = -self.tables.probe_wdl(board)
+                    dtz = abs(self.tables.probe_dtz(board))
+                    # Winning: fast conversions first, losing: hold out as long as possible
+                    key = (wdl, 0, zeroing, -dtz) if wdl > 0 else (wdl, 0, -zeroing, dtz)
+            finally:
+                board.pop()
+            if best_key is None or key > best_key:
+                best, best_key = move, key
+
+        if best is None:
+            return None
+
+        wdl = self.tables.probe_wdl(board)
+        verdict = {"Move": best.uci(), "Centipawn": None, "Mate": None}
+        if abs(wdl) < 2:
+            verdict["Centipawn"] = 0
+        elif best_key[1]:
+            verdict["Mate"] = 1
+        else:
+            moves = max((abs(self.tables.probe_dtz(board)) + 1) // 2, 1)
+            verdict["Mate"] = moves if wdl > 0 else -moves
+        return verdict
@@ -0,0 +1,196 @@
+import asyncio
+import subprocess
+
+
+class EngineError(Exception):
+    """ Raised when the engine process died or answered something unexpected """
+
+
+def go_command(depth: int, searchmoves: list = None) -> str:
+    command = f"go depth {depth}"
+    if searchmoves:
+        command += " searchmoves " + " ".join(searchmoves)
+    return command
+
+
+def parse_search(output: list) -> list:
+    """ {"Move", "Centipawn", "Mate", "Nodes"} of every multipv line, from the last info line of each """
+    lines = {}
+    for line in output:
+        if not line.startswith("info") or " score " not in line or " pv " not in line:
+            continue
+        tokens = line.split()
+        number = int(tokens[tokens.index("multipv") + 1]) if "multipv" in tokens else 1
+        lines[number] = tokens
+
+    results = []
+    for number in sorted(lines):
+        tokens = lines[number]
+        kind, value = tokens[tokens.index("score") + 1:tokens.index("score") + 3]
+        results.append({
+            "Move": tokens[tokens.index("pv") + 1],
+            "Centipawn": int(value) if kind == "cp" else None,
+            "Mate": int(value) if kind == "mate" else None,
+            "Nodes": int(tokens[tokens.index("nodes") + 1]) if "nodes" in tokens else 0,
+        })
+    return results
+
+
+class UciEngine:
+    """
+        Minimal synchronous UCI client of one engine process.
+
+        The process stays up between searches, options are only sent when they change and
+        ucinewgame only when the game token of a search differs from the previous one.
+        Search results are {"Move", "Centipawn", "Mate", "Nodes"} with scores from the side
+        to move's point of view (the first element of search() is the best line).
+    """
+
+    def __init__(self, path: str, options: dict = None) -> None:
+        self.process = subprocess.Popen([path], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        universal_newlines=True, bufsize=1)
+        self.options = {}
+        self.game = None
+        self._first_game = True
+
+        self._send("uci")
+        self._read_until("uciok")
+        for name, value in (options or {}).items():
+            self.set_option(name, value)
+        self.set_option("MultiPV", 1)
+        self._ready()
+
+    def set_option(self, name: str, value) -> None:
+        if self.options.get(name) != value:
+            if isinstance(value, bool):
+                value = str(value).lower()
+            self._send(f"setoption name {name} value {value}")
+            self.options[name] = value
+
+    def new_game(self, game: object = None) -> None:
+        """ Clears the engine's hash when the position does not belong to the game of the last search """
+        if self._first_game or game is not self.game:
+            self._first_game = False
+            self.game = game
+            self._send("ucinewgame")
+            self._ready()
+
+    def search(self, fen_position: str, depth: int, game: object = None, multipv: int = 1,
+               searchmoves: list = None) -> list:
+        """
+            Searches the position to the given depth. Returns the multipv best lines, best first,
+            or the lines of the given UCI moves only (searchmoves). Empty when there is no legal move
+        """
+        self.new_game(game)
+        self.set_option("MultiPV", multipv)
+        self._send(f"position fen {fen_position}")
+        self._send(go_command(depth, searchmoves))
+
+        return parse_search(self._read_until("bestmove"))
+
+    def quit(self) -> None:
+        try:
+            self._send("quit")
+            self.process.wait(timeout=5)
+        except (EngineError, subprocess.TimeoutExpired):
+            self.process.kill()
+
+    def _send(self, command: str) -> None:
+        try:
+            self.process.stdin.write(command + "\n")
+            self.process.stdin.flush()
+        except (BrokenPipeError, ValueError):
+            raise EngineError("engine process is not running")
+
+    def _ready(self) -> None:
+        self._send("isready")
+        self._read_until("readyok")
+
+    def _read_until(self, token: str) -> list:
+        """ Output lines up to (and including) the first one that starts with token """
+        lines = []
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                raise EngineError(f"engine exited while waiting for {token}")
+            line = line.rstrip()
+            lines.append(line)
+            if line.startswith(token):
+                return lines
+
+
+class AsyncUciEngine:
+    """
+        asyncio version of UciEngine, same protocol and results. Many of them are driven by one
+        event loop, create them with start() inside the loop that uses them
+    """
+
+    def __init__(self, process: asyncio.subprocess.Process) -> None:
+        self.process = process
+        self.options = {}
+        self.game = None
+        self._first_game = True
+
+    @classmethod
+    async def start(cls, path: str, options: dict = None) -> "AsyncUciEngine":
+        process = await asyncio.create_subprocess_exec(path, stdin=asyncio.subprocess.PIPE,
+                                                       stdout=asyncio.subprocess.PIPE)
+        engine = cls(process)
+        engine._send("uci")
+        await engine._read_until("uciok")
+        for name, value in (options or {}).items():
+            engine.set_option(name, value)
+        engine.set_option("MultiPV", 1)
+        await engine._ready()
+        return engine
+
+    def set_option(self, name: str, value) -> None:
+        if self.options.get(name) != value:
+            if isinstance(value, bool):
+                value = str(value).lower()
+            self._send(f"setoption name {name} value {value}")
+            self.options[name] = value
+
+    async def new_game(self, game: object = None) -> None:
+        if self._first_game or game is not self.game:
+            self._first_game = False
+            self.game = game
+            self._send("ucinewgame")
+            await self._ready()
+
+    async def search(self, fen_position: str, depth: int, game: object = None, multipv: int = 1,
+                     searchmoves: list = None) -> list:
+        """ See UciEngine.search """
+        await self.new_game(game)
+        self.set_option("MultiPV", multipv)
+        self._send(f"position fen {fen_position}")
+        self._send(go_command(depth, searchmoves))
+        return parse_search(await self._read_until("bestmove"))
+
+    async def quit(self) -> None:
+        try:
+            self._send("quit")
+            await asyncio.wait_for(self.process.wait(), timeout=5)
+        except (EngineError, asyncio.TimeoutError):
+            self.process.kill()
+            await self.process.wait()
+
+    def _send(self, command: str) -> None:
+        if self.process.returncode is not None or self.process.stdin.is_closing():
+            raise EngineError("engine process is not running")
+        self.process.stdin.write((command + "\n").encode())
+
+    async def _ready(self) -> None:
+        self._send("isready")
+        await self._read_until("readyok")
+
+    async def _read_until(self, token: str) -> list:
+        lines = []
+        while True:
+            line = await self.process.stdout.readline()
+            if not line:
+                raise EngineError(f"engine exited while waiting for {token}")
+            line = line.decode().rstrip()
+            lines.append(line)
+            if line.startswith(token):
+                return lines